@@ -0,0 +1,335 @@
+# columns_ai.py
+# Plans where to place fallers by searching every placement of the current
+# and the next faller.
+import collections
+import random
+import columns_model
+import columns_session
+
+TABLE_SIZE = 200000
+CLEAR_VALUE = 10.0
+HEIGHT_WEIGHT = 0.5
+NEIGHBOR_VALUE = 1.0
+LOSS_VALUE = float("-inf")
+
+
+def default_evaluation(stacks: [[str]], rows: int) -> float:
+    '''
+    Scores a settled field given as stacks of colors from the bottom of
+    each column up. Tall columns are bad, especially near the top, and
+    neighbouring jewels of the same color are good since they can turn
+    into matches.
+    '''
+    value = 0.0
+    for col, stack in enumerate(stacks):
+        value -= HEIGHT_WEIGHT*len(stack)*len(stack)/rows
+        for height, color in enumerate(stack):
+            if height + 1 < len(stack) and stack[height + 1] == color:
+                value += NEIGHBOR_VALUE
+            if col + 1 < len(stacks):
+                right = stacks[col + 1]
+                for neighbor in (height - 1, height, height + 1):
+                    if 0 <= neighbor < len(right) and right[neighbor] == color:
+                        value += NEIGHBOR_VALUE
+    return value
+
+
+class Placement:
+    '''
+    Stores a column and number of rotations for a faller along with the
+    value the planner gave it.
+    '''
+
+    def __init__(self, col: int, rotations: int, value: float):
+        self._col = col
+        self._rotations = rotations
+        self._value = value
+
+    def col(self) -> int:
+        '''
+        Returns the column to drop the faller in.
+        '''
+        return self._col
+
+    def rotations(self) -> int:
+        '''
+        Returns the number of times to rotate the faller.
+        '''
+        return self._rotations
+
+    def value(self) -> float:
+        '''
+        Returns the value of the placement.
+        '''
+        return self._value
+
+
+class Planner:
+    '''
+    Searches the placements of the current faller and the next faller,
+    settling each landing and its chain reactions, and picks the best one
+    by the evaluation function. Between placements the field is always
+    settled, so boards are kept as stacks of colors per column and hashed
+    with Zobrist keys. Subtree values and board evaluations are kept in a
+    transposition table that drops the least recently used entries once
+    it holds table_size of them.
+
+    The next faller is created in a random column, so every column that
+    isn't full is treated as reachable for it.
+    '''
+
+    def __init__(self, evaluate=default_evaluation, clear_value: float = CLEAR_VALUE, table_size: int = TABLE_SIZE, seed: int = 0):
+        self._evaluate = evaluate
+        self._clear_value = clear_value
+        self._table_size = table_size
+        self._table = collections.OrderedDict()
+        self._random = random.Random(seed)
+        self._keys = {}
+
+    def plan(self, state: columns_model.GameState, next_colors: [str] = None) -> Placement:
+        '''
+        Returns the best placement of the state's faller, looking ahead to
+        the next faller if its colors are given. Returns None if there is
+        no faller.
+        '''
+        faller = state.faller()
+        if faller is None:
+            return None
+        self._rows = state.rows() - state.buffer_size()
+        self._total_rows = state.rows()
+        self._rules = state.rules()
+        self._matching_rows = self._total_rows if self._rules.match_buffer() else self._rows
+        self._directions = [(dcol, -drow)
+                            for drow, dcol in self._rules.directions()]
+        stacks = self._read_stacks(state)
+        hashes = [self._hash_column(col, stack)
+                  for col, stack in enumerate(stacks)]
+
+        best = None
+        for col in self._reachable_cols(stacks, faller):
+            for rotations, colors in self._rotations(faller.colors()):
+                child, child_hashes, cleared = self._place(
+                    stacks, hashes, col, colors)
+                if child is None:
+                    value = LOSS_VALUE
+                elif next_colors:
+                    value = self._clear_value*cleared + \
+                        self._best_value(child, child_hashes, next_colors)
+                else:
+                    value = self._clear_value*cleared + \
+                        self._board_value(child, child_hashes)
+                if best is None or value > best.value():
+                    best = Placement(col, rotations, value)
+        return best
+
+    def _best_value(self, stacks: [[str]], hashes: [int], colors: [str]) -> float:
+        '''
+        Returns the value of the best placement of a faller with the given
+        colors anywhere on a board.
+        '''
+        key = (self._combine(hashes), tuple(colors))
+        if key in self._table:
+            self._table.move_to_end(key)
+            return self._table[key]
+        best = LOSS_VALUE
+        for col in range(len(stacks)):
+            if len(stacks[col]) >= self._rows:
+                continue
+            for rotations, rotated in self._rotations(colors):
+                child, child_hashes, cleared = self._place(
+                    stacks, hashes, col, rotated)
+                if child is not None:
+                    best = max(best, self._clear_value*cleared +
+                               self._board_value(child, child_hashes))
+        self._store(key, best)
+        return best
+
+    def _board_value(self, stacks: [[str]], hashes: [int]) -> float:
+        '''
+        Returns the memoized evaluation of a board.
+        '''
+        key = self._combine(hashes)
+        if key in self._table:
+            self._table.move_to_end(key)
+            return self._table[key]
+        value = self._evaluate(stacks, self._rows)
+        self._store(key, value)
+        return value
+
+    def _store(self, key, value: float) -> None:
+        '''
+        Adds a value to the transposition table, dropping the least
+        recently used entry if it is full.
+        '''
+        self._table[key] = value
+        if len(self._table) > self._table_size:
+            self._table.popitem(last=False)
+
+    def _place(self, stacks: [[str]], hashes: [int], col: int, colors: [str]) -> ([[str]], [int], int):
+        '''
+        Lands a faller in a column and settles the chain reactions. Returns
+        the new stacks, their column hashes and the number of jewels
+        cleared, or None for the stacks if the game would be lost.
+        '''
+        stacks = stacks[:]
+        hashes = hashes[:]
+        stack = stacks[col] + list(reversed(colors))
+        stacks[col] = stack
+        changed = [(col, height)
+                   for height in range(len(stack) - len(colors), len(stack))]
+        cleared = 0
+        touched = {col}
+        while True:
+            matching = self._find_matching(stacks, changed)
+            if not matching:
+                break
+            cleared += len(matching)
+            changed = []
+            for match_col in {match_col for match_col, height in matching}:
+                lowest = min(height for other, height in matching
+                             if other == match_col)
+                stacks[match_col] = [color for height, color in enumerate(stacks[match_col])
+                                     if (match_col, height) not in matching]
+                changed += [(match_col, height)
+                            for height in range(lowest, len(stacks[match_col]))]
+                touched.add(match_col)
+        for touched_col in touched:
+            if len(stacks[touched_col]) > self._rows:
+                return None, None, cleared
+            hashes[touched_col] = self._hash_column(
+                touched_col, stacks[touched_col])
+        return stacks, hashes, cleared
+
+    def _find_matching(self, stacks: [[str]], cells: [(int, int)]) -> {(int, int)}:
+        '''
+        Finds the runs as long as the match rules' length or more that pass
+        through the given cells, in (column, height) positions.
+        '''
+        matching = set()
+        for col, height in cells:
+            color = self._color_at(stacks, col, height)
+            if color is None:
+                continue
+            for dcol, dheight in self._directions:
+                start_col, start_height = col, height
+                while self._color_at(stacks, start_col - dcol, start_height - dheight) == color:
+                    start_col -= dcol
+                    start_height -= dheight
+                run = []
+                while self._color_at(stacks, start_col, start_height) == color:
+                    run.append((start_col, start_height))
+                    start_col += dcol
+                    start_height += dheight
+                if len(run) >= self._rules.length():
+                    matching.update(run)
+        return matching
+
+    def _color_at(self, stacks: [[str]], col: int, height: int) -> str:
+        '''
+        Returns the color at a position that can match, or None.
+        '''
+        if 0 <= col < len(stacks) and 0 <= height < len(stacks[col]) and height < self._matching_rows:
+            return stacks[col][height]
+        return None
+
+    def _reachable_cols(self, stacks: [[str]], faller: columns_model.Faller) -> [int]:
+        '''
+        Returns the columns the faller can move to from where it is.
+        '''
+        blocked_height = self._total_rows - faller.bottom()
+        cols = [faller.col()]
+        for direction in (columns_model.LEFT, columns_model.RIGHT):
+            col = faller.col() + direction
+            while 0 <= col < len(stacks) and len(stacks[col]) < blocked_height:
+                cols.append(col)
+                col += direction
+        return cols
+
+    def _rotations(self, colors: [str]) -> [(int, [str])]:
+        '''
+        Returns the distinct color orders a faller can be rotated to, with
+        the number of rotations needed for each.
+        '''
+        seen = set()
+        rotations = []
+        for rotation in range(len(colors)):
+            if rotation:
+                colors = [colors[-1]] + colors[:-1]
+            if tuple(colors) not in seen:
+                seen.add(tuple(colors))
+                rotations.append((rotation, colors))
+        return rotations
+
+    def _read_stacks(self, state: columns_model.GameState) -> [[str]]:
+        '''
+        Returns the jewels of the field as stacks from the bottom up,
+        leaving out the faller.
+        '''
+        stacks = []
+        for col in range(state.cols()):
+            stack = []
+            for row in range(state.rows() - 1, -1, -1):
+                if state.get_type(row, col) in (columns_model.JEWEL, columns_model.MATCHING):
+                    stack.append(state.get(row, col))
+                elif state.get_type(row, col) == columns_model.NONE:
+                    break
+            stacks.append(stack)
+        return stacks
+
+    def _hash_column(self, col: int, stack: [str]) -> int:
+        '''
+        Returns the Zobrist hash of a column.
+        '''
+        value = 0
+        for height, color in enumerate(stack):
+            key = (col, height, color)
+            if key not in self._keys:
+                self._keys[key] = self._random.getrandbits(64)
+            value ^= self._keys[key]
+        return value
+
+    def _combine(self, hashes: [int]) -> int:
+        '''
+        Returns the Zobrist hash of a board from its column hashes.
+        '''
+        value = 0
+        for column in hashes:
+            value ^= column
+        return value
+
+
+class PlannerPolicy:
+    '''
+    Plays a session by asking the planner where each new faller should go
+    and then giving the inputs to get it there. It can be used as a policy
+    for columns_runner.
+    '''
+
+    def __init__(self, planner: Planner = None):
+        self._planner = planner or Planner()
+        self._piece = None
+        self._target = None
+        self._rotations = 0
+
+    def __call__(self, session: columns_session.GameSession, rng: random.Random = None) -> int:
+        '''
+        Returns the next input towards the planned placement.
+        '''
+        state = session.state()
+        faller = state.faller()
+        if faller is None:
+            return None
+        if self._piece != session.pieces():
+            self._piece = session.pieces()
+            self._target = self._planner.plan(state, session.next_colors())
+            self._rotations = 0
+        if self._target is None:
+            return columns_session.HARD_DROP
+        if self._rotations < self._target.rotations():
+            self._rotations += 1
+            return columns_session.ROTATE
+        if faller.col() < self._target.col() and state.cols() > faller.col() + 1:
+            return columns_session.MOVE_RIGHT
+        if faller.col() > self._target.col():
+            return columns_session.MOVE_LEFT
+        return columns_session.HARD_DROP
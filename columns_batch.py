@@ -0,0 +1,290 @@
+# columns_batch.py
+# A headless engine that steps many independent columns games at once.
+import numpy
+from columns_model import BLANK, BUFFER_SIZE, COLORS, DEFAULT_RULES, FALLER_LENGTH, MatchRules
+from columns_numpy import BLANK_CODE, drop_cells, find_matching
+
+NOOP = 0
+MOVE_LEFT = 1
+MOVE_RIGHT = 2
+ROTATE = 3
+DROP = 4
+
+
+class BatchGameState:
+    '''
+    Stores a number of independent games in stacked arrays and steps all
+    of them with a single call. The rules are the same as
+    columns_model.GameState, with fallers created the same way as in the
+    pygame game: in a random column that isn't full, with the colors that
+    were queued up as the next faller. All games use the same match rules.
+    Without auto_fallers, fallers are only created by initialize_faller,
+    the same as with a columns_model.GameState.
+    '''
+
+    def __init__(self, games: int, rows: int, cols: int, colors: [str] = COLORS, seed: int = None, rules: MatchRules = DEFAULT_RULES, auto_fallers: bool = True):
+        self._games = games
+        self._rules = rules
+        self._auto_fallers = auto_fallers
+        self._rows = rows+BUFFER_SIZE
+        self._cols = cols
+        self._color_table = [BLANK] + list(colors)
+        self._rng = numpy.random.default_rng(seed)
+
+        self._cells = numpy.zeros(
+            (games, self._rows, cols), dtype=numpy.uint8)
+        self._matching = numpy.zeros(self._cells.shape, dtype=bool)
+        self._has_matching = numpy.zeros(games, dtype=bool)
+        self._faller_col = numpy.zeros(games, dtype=numpy.intp)
+        self._faller_bottom = numpy.zeros(games, dtype=numpy.intp)
+        self._faller_colors = numpy.zeros(
+            (games, FALLER_LENGTH), dtype=numpy.uint8)
+        self._has_faller = numpy.zeros(games, dtype=bool)
+        self._next_colors = self._random_colors(games)
+        self._scores = numpy.zeros(games, dtype=numpy.int64)
+        self._game_over = numpy.zeros(games, dtype=bool)
+
+    def games(self) -> int:
+        '''
+        Returns the number of games.
+        '''
+        return self._games
+
+    def color_table(self) -> [str]:
+        '''
+        Returns the color of each code on the boards, code 0 is blank.
+        '''
+        return self._color_table
+
+    def cells(self) -> numpy.ndarray:
+        '''
+        Returns the color codes of the fields, without the fallers.
+        '''
+        return self._cells
+
+    def matching(self) -> numpy.ndarray:
+        '''
+        Returns a boolean mask of the matching jewels of every game.
+        '''
+        return self._matching
+
+    def boards(self) -> numpy.ndarray:
+        '''
+        Returns a copy of the color codes of every game with the fallers
+        drawn in.
+        '''
+        boards = self._cells.copy()
+        games = numpy.flatnonzero(self._has_faller)
+        rows = self._faller_rows(games)
+        boards[games[:, None], rows, self._faller_col[games, None]] = \
+            self._faller_colors[games]
+        return boards
+
+    def faller(self, game: int) -> (int, [int], [str]):
+        '''
+        Returns the column, rows and colors of the faller of a game from top
+        to bottom, or None if it has none.
+        '''
+        if not self._has_faller[game]:
+            return None
+        rows = self._faller_rows(numpy.array([game]))[0]
+        return (int(self._faller_col[game]), rows.tolist(),
+                [self._color_table[code] for code in self._faller_colors[game]])
+
+    def scores(self) -> numpy.ndarray:
+        '''
+        Returns the score of every game.
+        '''
+        return self._scores
+
+    def game_over(self) -> numpy.ndarray:
+        '''
+        Returns the game over state of every game.
+        '''
+        return self._game_over
+
+    def reset(self, games: numpy.ndarray = None) -> None:
+        '''
+        Starts the given games (all of them if None) over with an empty
+        field.
+        '''
+        if games is None:
+            games = numpy.arange(self._games)
+        self._cells[games] = BLANK_CODE
+        self._matching[games] = False
+        self._has_matching[games] = False
+        self._has_faller[games] = False
+        self._scores[games] = 0
+        self._game_over[games] = False
+
+    def initialize_contents(self, game: int, contents: [[str]]) -> None:
+        '''
+        Sets the field of a game below the buffer to the given colors, then
+        drops and matches it.
+        '''
+        codes = {color: code for code, color in enumerate(self._color_table)}
+        self._cells[game, BUFFER_SIZE:BUFFER_SIZE+len(contents)] = [
+            [codes[color] for color in row] for row in contents]
+        self._settle(numpy.array([game]))
+
+    def initialize_faller(self, game: int, col: int, colors: [str]) -> None:
+        '''
+        Creates a faller in a game if it has none and nothing is matching,
+        or ends the game if the column is full.
+        '''
+        if self._has_faller[game] or self._has_matching[game]:
+            return
+        if self._cells[game, BUFFER_SIZE:, col].all():
+            self._game_over[game] = True
+            return
+        codes = {color: code for code, color in enumerate(self._color_table)}
+        self._faller_col[game] = col
+        self._faller_bottom[game] = FALLER_LENGTH - 1
+        self._faller_colors[game] = [codes[color] for color in colors]
+        self._has_faller[game] = True
+
+    def step(self, actions: numpy.ndarray) -> (numpy.ndarray, numpy.ndarray, numpy.ndarray):
+        '''
+        Applies one action to each game and then updates every game once.
+        Returns copies of the boards, scores and game over states, so that
+        later steps don't change them.
+        '''
+        self.apply(actions)
+        self._update()
+        return self.boards(), self._scores.copy(), self._game_over.copy()
+
+    def apply(self, actions: numpy.ndarray) -> None:
+        '''
+        Applies one action to each game without updating them.
+        '''
+        actions = numpy.asarray(actions)
+        active = self._has_faller & ~self._game_over
+        self._move_fallers(
+            numpy.flatnonzero(active & (actions == MOVE_LEFT)), -1)
+        self._move_fallers(
+            numpy.flatnonzero(active & (actions == MOVE_RIGHT)), 1)
+        self._rotate_fallers(numpy.flatnonzero(active & (actions == ROTATE)))
+        self._drop_fallers(numpy.flatnonzero(active & (actions == DROP)))
+
+    def _update(self) -> None:
+        '''
+        Updates every game that isn't over, then scores the matching jewels
+        and creates fallers where there are none if auto_fallers is on. Only
+        the games where a faller froze or jewels are matching are cleared,
+        dropped and matched again, since nothing else changes a field. The
+        others were already settled and checked for game over when their
+        fields last changed.
+        '''
+        playing = ~self._game_over
+        fallers = numpy.flatnonzero(self._has_faller & playing)
+        landed = self._landed(fallers)
+        self._freeze_fallers(fallers[landed])
+        self._faller_bottom[fallers[~landed]] += 1
+
+        changed = self._has_matching & playing
+        changed[fallers[landed]] = True
+        games = numpy.flatnonzero(changed)
+        if len(games):
+            cells, matching = self._settle(games)
+            found = self._has_matching[games]
+            buffer_used = cells[:, :BUFFER_SIZE].any(axis=(1, 2))
+            self._game_over[games[~found & buffer_used]] = True
+            self._scores[games] += matching.sum(axis=(1, 2))
+        if self._auto_fallers:
+            self._create_fallers(numpy.flatnonzero(
+                ~self._game_over & ~self._has_faller & ~self._has_matching))
+
+    def _settle(self, games: numpy.ndarray) -> (numpy.ndarray, numpy.ndarray):
+        '''
+        Clears the matching jewels of the games, drops their fields and
+        finds the new matching jewels. Returns the games' cells and matching
+        masks.
+        '''
+        cells = self._cells[games]
+        cells[self._matching[games]] = BLANK_CODE
+        cells = drop_cells(cells)
+        matching = find_matching(cells, self._rules.first_row(BUFFER_SIZE),
+                                 self._rules.length(), self._rules.diagonals())
+        self._cells[games] = cells
+        self._matching[games] = matching
+        self._has_matching[games] = matching.any(axis=(1, 2))
+        return cells, matching
+
+    def _create_fallers(self, games: numpy.ndarray) -> None:
+        '''
+        Creates fallers in a random column that isn't full, or ends the
+        games that have no such column.
+        '''
+        if len(games) == 0:
+            return
+        full = self._cells[games, BUFFER_SIZE:].all(axis=1)
+        stuck = full.all(axis=1)
+        self._game_over[games[stuck]] = True
+        games, full = games[~stuck], full[~stuck]
+        choice = self._rng.random(full.shape)
+        choice[full] = -1
+        self._faller_col[games] = choice.argmax(axis=1)
+        self._faller_bottom[games] = FALLER_LENGTH - 1
+        self._faller_colors[games] = self._next_colors[games]
+        self._has_faller[games] = True
+        self._next_colors[games] = self._random_colors(len(games))
+
+    def _move_fallers(self, games: numpy.ndarray, direction: int) -> None:
+        '''
+        Moves the fallers of the games left or right if the cells next to
+        them are empty.
+        '''
+        cols = self._faller_col[games] + direction
+        inside = (cols >= 0) & (cols < self._cols)
+        games, cols = games[inside], cols[inside]
+        rows = self._faller_rows(games)
+        empty = ~self._cells[games[:, None], rows, cols[:, None]].any(axis=1)
+        self._faller_col[games[empty]] = cols[empty]
+
+    def _rotate_fallers(self, games: numpy.ndarray) -> None:
+        '''
+        Rotates the colors of the fallers of the games.
+        '''
+        self._faller_colors[games] = numpy.roll(
+            self._faller_colors[games], 1, axis=1)
+
+    def _drop_fallers(self, games: numpy.ndarray) -> None:
+        '''
+        Moves the fallers of the games straight down to where they land.
+        '''
+        column = self._cells[games, :, self._faller_col[games]] != BLANK_CODE
+        below = numpy.arange(self._rows) > self._faller_bottom[games, None]
+        blocked = column & below
+        first = numpy.where(blocked.any(axis=1),
+                            blocked.argmax(axis=1), self._rows)
+        self._faller_bottom[games] = first - 1
+
+    def _freeze_fallers(self, games: numpy.ndarray) -> None:
+        '''
+        Freezes the fallers of the games into their fields.
+        '''
+        rows = self._faller_rows(games)
+        self._cells[games[:, None], rows, self._faller_col[games, None]] = \
+            self._faller_colors[games]
+        self._has_faller[games] = False
+
+    def _landed(self, games: numpy.ndarray) -> numpy.ndarray:
+        '''
+        Checks if the fallers of the games have landed.
+        '''
+        bottom = self._faller_bottom[games]
+        below = numpy.minimum(bottom + 1, self._rows - 1)
+        return (bottom == self._rows - 1) | (
+            self._cells[games, below, self._faller_col[games]] != BLANK_CODE)
+
+    def _faller_rows(self, games: numpy.ndarray) -> numpy.ndarray:
+        '''
+        Returns the rows of the fallers of the games, from top to bottom.
+        '''
+        return self._faller_bottom[games, None] - numpy.arange(FALLER_LENGTH - 1, -1, -1)
+
+    def _random_colors(self, count: int) -> numpy.ndarray:
+        '''
+        Returns the color codes of a number of random fallers.
+        '''
+        return self._rng.integers(1, len(self._color_table), size=(count, FALLER_LENGTH), dtype=numpy.uint8)
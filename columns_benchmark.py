@@ -0,0 +1,191 @@
+# columns_benchmark.py
+# Times the hot paths of the model and the renderer and compares them to a
+# saved baseline.
+import argparse
+import json
+import os
+import random
+import time
+import columns_bitboard
+import columns_model
+
+SIZES = [(13, 6), (26, 12), (52, 24)]
+DENSITIES = [0.25, 0.5, 0.75]
+REPEATS = 5
+CALLS = 50
+THRESHOLD = 0.1
+
+
+def field_classes() -> {str: type}:
+    '''
+    Returns the field backends that can be imported here.
+    '''
+    classes = {"list": columns_model.Field,
+               "bitboard": columns_bitboard.BitboardField}
+    try:
+        import columns_numpy
+        classes["numpy"] = columns_numpy.NumpyField
+    except ImportError:
+        pass
+    return classes
+
+
+def make_state(field_class: type, rows: int, cols: int, density: float, seed: int, colors: [str] = columns_model.COLORS) -> columns_model.GameState:
+    '''
+    Returns a game state with a field filled to a density with random
+    colors, settled, and with a faller at the top of a column.
+    '''
+    rng = random.Random(seed)
+    state = columns_model.GameState(field_class)
+    state.initialize_field(rows, cols)
+    state.initialize_contents([[rng.choice(colors) if rng.random() < density else columns_model.BLANK
+                                for col in range(cols)] for row in range(rows)])
+    state.resolve_cascade()
+    state.initialize_faller(rng.randrange(cols), [rng.choice(
+        colors) for jewel in range(columns_model.FALLER_LENGTH)])
+    return state
+
+
+def make_field(field_class: type, rows: int, cols: int, density: float, seed: int):
+    '''
+    Returns a field filled to a density with random colors, left floating
+    and with every cell still to be scanned.
+    '''
+    rng = random.Random(seed)
+    field = field_class(rows, cols, columns_model.BUFFER_SIZE)
+    for row in range(columns_model.BUFFER_SIZE, field.rows()):
+        for col in range(cols):
+            if rng.random() < density:
+                field.set_color(row, col, rng.choice(columns_model.COLORS))
+    return field
+
+
+def time_calls(setup, run) -> float:
+    '''
+    Returns the best time per call out of REPEATS rounds of CALLS calls.
+    The setup makes the argument of each call and isn't timed.
+    '''
+    best = None
+    for repeat in range(REPEATS):
+        arguments = [setup(call) for call in range(CALLS)]
+        start = time.perf_counter()
+        for argument in arguments:
+            run(argument)
+        elapsed = (time.perf_counter() - start)/CALLS
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def read_board(state: columns_model.GameState) -> None:
+    '''
+    Reads the type and color of every cell of a state.
+    '''
+    for row in range(state.rows()):
+        for col in range(state.cols()):
+            state.get_type(row, col)
+            state.get(row, col)
+
+
+def model_benchmarks() -> {str: float}:
+    '''
+    Times locate_matching, drop_field, update and reading the whole board
+    cell by cell and as a render grid, for every field backend, board size
+    and density.
+    '''
+    results = {}
+    for name, field_class in field_classes().items():
+        for rows, cols in SIZES:
+            for density in DENSITIES:
+                case = f"{name}/{rows}x{cols}/{density}"
+                field = make_field(field_class, rows, cols, density, 0)
+                state = make_state(field_class, rows, cols, density, 0)
+                results[f"locate_matching/{case}"] = time_calls(
+                    lambda call: field.clone(), lambda copy: copy.locate_matching())
+                results[f"drop_field/{case}"] = time_calls(
+                    lambda call: field.clone(), lambda copy: copy.drop_field())
+                results[f"update/{case}"] = time_calls(
+                    lambda call: state.clone(), lambda copy: copy.update())
+                results[f"read_board/{case}"] = time_calls(
+                    lambda call: state, read_board)
+                results[f"render_grid/{case}"] = time_calls(
+                    lambda call: state.clone(), lambda copy: copy.render_grid())
+    return results
+
+
+def render_benchmarks() -> {str: float}:
+    '''
+    Times a full ColumnsGame._redraw onto an off-screen display at every
+    density, with and without dirty rectangles. Returns nothing if pygame
+    can't be imported.
+    '''
+    os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+    try:
+        import pygame
+        import game
+    except ImportError:
+        return {}
+    results = {}
+    for dirty_rects in (False, True):
+        for density in DENSITIES:
+            columns_game = game.ColumnsGame(dirty_rects)
+            columns_game._setup()
+            state = make_state(columns_model.Field, game.ROWS,
+                               game.COLUMNS, density, 0, list(game.COLORS.keys()))
+            columns_game._state = state
+            columns_game._session._state = state
+
+            def redraw(call: int) -> None:
+                if call % 2:
+                    state.move_faller(columns_model.LEFT)
+                else:
+                    state.move_faller(columns_model.RIGHT)
+                columns_game._publish_snapshot()
+                columns_game._redraw()
+            mode = "dirty" if dirty_rects else "full"
+            results[f"redraw/{mode}/{game.ROWS}x{game.COLUMNS}/{density}"] = time_calls(
+                lambda call: call, redraw)
+            pygame.quit()
+    return results
+
+
+def compare(results: {str: float}, baseline: {str: float}, threshold: float = THRESHOLD) -> [str]:
+    '''
+    Returns a line for every benchmark that is in the baseline, marking
+    the ones that got slower or faster by more than the threshold.
+    '''
+    lines = []
+    for name, seconds in sorted(results.items()):
+        if name not in baseline:
+            continue
+        ratio = seconds/baseline[name]
+        mark = "slower" if ratio > 1 + threshold else "faster" if ratio < 1 - threshold else ""
+        lines.append(
+            f"{name:48} {baseline[name]*1e6:10.1f}us {seconds*1e6:10.1f}us {ratio:6.2f}x {mark}")
+    return lines
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Times the hot paths of the columns game.")
+    parser.add_argument("--output", default="benchmark.json",
+                        help="file to write the results to")
+    parser.add_argument("--baseline", default=None,
+                        help="results file to compare against")
+    parser.add_argument("--threshold", type=float, default=THRESHOLD)
+    parser.add_argument("--no-render", action="store_true")
+    args = parser.parse_args()
+
+    results = model_benchmarks()
+    if not args.no_render:
+        results.update(render_benchmarks())
+    with open(args.output, "w") as file:
+        json.dump({"results": results}, file, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)["results"]
+        lines = compare(results, baseline, args.threshold)
+        print("\n".join(lines))
+        raise SystemExit(1 if any(line.endswith("slower") for line in lines) else 0)
+    for name, seconds in sorted(results.items()):
+        print(f"{name:48} {seconds*1e6:10.1f}us")
@@ -0,0 +1,335 @@
+# columns_bitboard.py
+# A field for the columns game that stores each color as a bitmask.
+from columns_model import BLANK, DEFAULT_RULES, Faller, MatchRules
+
+
+class BitboardField:
+    '''
+    Stores the data of the field as one integer bitmask per color, which
+    can be used in place of columns_model.Field. Each row takes up cols + 1
+    bits, the extra bit is always empty so that runs can't wrap around to
+    the next row. Only runs through the cells a jewel was placed in since
+    the last scan are looked for, since no other run can be new, and cell
+    reads come from a decoded copy of the colors that is kept until the
+    next write.
+    '''
+
+    def __init__(self, rows: int, cols: int, buffer_size: int, rules: MatchRules = DEFAULT_RULES):
+        self._rows = rows+buffer_size
+        self._cols = cols
+        self._buffer_size = buffer_size
+        self._rules = rules
+        self._width = cols+1
+        self._colors = {}
+        self._occupied = 0
+        self._matching = 0
+        self._placed = 0
+        self._decoded = None
+        self._journal = None
+
+        row_mask = (1 << cols) - 1
+        self._board = sum(row_mask << (row*self._width)
+                          for row in range(self._rows))
+        self._buffer = sum(row_mask << (row*self._width)
+                           for row in range(buffer_size))
+        self._matching_area = self._board if rules.match_buffer() else self._board & ~self._buffer
+        self._shifts = [drow*self._width + dcol
+                        for drow, dcol in rules.directions()]
+        self._above_floor = self._board & ~(
+            row_mask << ((self._rows-1)*self._width))
+        self._column_masks = [sum(self._bit(row, col) for row in range(
+            buffer_size, self._rows)) for col in range(cols)]
+        self._whole_columns = [sum(self._bit(row, col) for row in range(
+            self._rows)) for col in range(cols)]
+
+    def rows(self) -> int:
+        '''
+        Returns the number of rows in the field.
+        '''
+        return self._rows
+
+    def cols(self) -> int:
+        '''
+        Returns the number of columns in the fields.
+        '''
+        return self._cols
+
+    def buffer_size(self) -> int:
+        '''
+        Returns the size of the buffer.
+        '''
+        return self._buffer_size
+
+    def rules(self) -> MatchRules:
+        '''
+        Returns the match rules.
+        '''
+        return self._rules
+
+    def matching(self) -> [(int, int)]:
+        '''
+        Returns the matching jewel positions.
+        '''
+        return self._cells_in(self._matching)
+
+    def get_color(self, row: int, col: int) -> str:
+        '''
+        Gets a color from a row and column.
+        '''
+        try:
+            return self._decoded[row][col]
+        except TypeError:
+            self._decoded = [self._decode_row(row)
+                             for row in range(self._rows)]
+            return self._decoded[row][col]
+
+    def get_row(self, row: int) -> [str]:
+        '''
+        Gets a copy of the colors of a row.
+        '''
+        if self._decoded is not None:
+            return self._decoded[row][:]
+        return self._decode_row(row)
+
+    def _decode_row(self, row: int) -> [str]:
+        '''
+        Returns the colors of a row read from the color masks.
+        '''
+        colors = [BLANK]*self._cols
+        shift = row*self._width
+        for color, mask in self._colors.items():
+            bits = (mask >> shift) & ((1 << self._cols) - 1)
+            while bits:
+                low = bits & -bits
+                colors[low.bit_length() - 1] = color
+                bits ^= low
+        return colors
+
+    def clone(self) -> 'BitboardField':
+        '''
+        Returns a copy of the field.
+        '''
+        field = BitboardField.__new__(BitboardField)
+        field._rows = self._rows
+        field._cols = self._cols
+        field._buffer_size = self._buffer_size
+        field._rules = self._rules
+        field._width = self._width
+        field._colors = dict(self._colors)
+        field._occupied = self._occupied
+        field._matching = self._matching
+        field._placed = self._placed
+        field._decoded = self._decoded
+        field._journal = None
+        field._board = self._board
+        field._buffer = self._buffer
+        field._matching_area = self._matching_area
+        field._shifts = self._shifts
+        field._above_floor = self._above_floor
+        field._column_masks = self._column_masks
+        field._whole_columns = self._whole_columns
+        return field
+
+    def set_color(self, row: int, col: int, val: str) -> None:
+        '''
+        Sets a color for a row and column.
+        '''
+        bit = self._bit(row, col)
+        old = BLANK
+        if self._occupied & bit:
+            for color, mask in self._colors.items():
+                if mask & bit:
+                    self._colors[color] = mask & ~bit
+                    old = color
+                    break
+        if self._journal is not None and old != val:
+            self._journal.append((row, col, old))
+        self._decoded = None
+        if val == BLANK:
+            self._occupied &= ~bit
+        else:
+            self._colors[val] = self._colors.get(val, 0) | bit
+            self._occupied |= bit
+            self._placed |= bit
+
+    def set_matching(self, matching: [(int, int)]) -> None:
+        '''
+        Replaces the matching jewel positions.
+        '''
+        self._matching = sum(self._bit(row, col) for row, col in matching)
+
+    def set_journal(self, journal: list) -> None:
+        '''
+        Sets a list that every change to a cell is appended to as the row,
+        column and old color, or None to stop.
+        '''
+        self._journal = journal
+
+    def clear_matching(self) -> None:
+        '''
+        Removes the matching blocks and then empties the mask.
+        '''
+        if self._matching:
+            if self._journal is not None:
+                for color, mask in self._colors.items():
+                    for row, col in self._cells_in(mask & self._matching):
+                        self._journal.append((row, col, color))
+            for color in self._colors:
+                self._colors[color] &= ~self._matching
+            self._occupied &= ~self._matching
+            self._matching = 0
+            self._decoded = None
+
+    def drop_field(self) -> None:
+        '''
+        Instantly drops all pieces in the field. Every jewel with an empty
+        cell below it moves down one row at a time until nothing can fall.
+        '''
+        width = self._width
+        falling = self._occupied & ~(self._occupied >> width) & self._above_floor
+        if not falling:
+            return
+        self._decoded = None
+        if self._journal is not None:
+            colors = dict(self._colors)
+            occupied = self._occupied
+        while falling:
+            for color, mask in self._colors.items():
+                moved = mask & falling
+                if moved:
+                    self._colors[color] = (mask & ~moved) | (moved << width)
+            self._occupied = (self._occupied & ~falling) | (falling << width)
+            self._placed |= falling << width
+            falling = self._occupied & ~(
+                self._occupied >> width) & self._above_floor
+            if not falling and self._journal is not None:
+                self._journal_changes(colors, occupied)
+
+    def locate_matching(self) -> None:
+        '''
+        Finds all matching jewels in all directions and then adds them to
+        the matching jewels mask. Only the colors of the placed jewels are
+        scanned, and only for runs that go through a placed jewel.
+        '''
+        placed = self._placed & self._matching_area
+        self._placed = 0
+        if not placed:
+            return
+        nears = None
+        for mask in self._colors.values():
+            mask &= self._matching_area
+            if mask & placed:
+                if nears is None:
+                    nears = [self._run_starts(placed, shift)
+                             for shift in self._shifts]
+                for shift, near in zip(self._shifts, nears):
+                    self._matching |= self._find_runs(mask, shift, near)
+
+    def matching_contains_cell(self, row: int, col: int) -> bool:
+        '''
+        Checks if a cell is in the matching jewels.
+        '''
+        return bool(self._matching) and bool(self._matching & self._bit(row, col))
+
+    def column_full(self, col: int) -> bool:
+        '''
+        Checks if a column is full.
+        '''
+        column = self._column_masks[col]
+        return self._occupied & column == column
+
+    def empty_buffer(self) -> bool:
+        '''
+        Checks if the buffer is empty.
+        '''
+        return not self._occupied & self._buffer
+
+    def no_matching(self) -> bool:
+        '''
+        Checks if the matching jewels mask is empty.
+        '''
+        return self._matching == 0
+
+    def empty_rows(self, col: int, rows: [int]) -> bool:
+        '''
+        Checks if a column is empty.
+        '''
+        if col < 0 or col > self._cols - 1:
+            return False
+        return not any(self._occupied & self._bit(row, col) for row in rows)
+
+    def is_landed(self, row: int, col: int) -> bool:
+        '''
+        Checks if a cell has landed (on top of a jewel or the floor).
+        '''
+        return row == self._rows - 1 or bool(self._occupied & self._bit(row + 1, col))
+
+    def landing_row(self, row: int, col: int) -> int:
+        '''
+        Returns the row a jewel falling from a row in a column lands on.
+        '''
+        below = self._occupied & self._whole_columns[col] & ~(
+            (self._bit(row, 0) << self._width) - 1)
+        if not below:
+            return self._rows - 1
+        return ((below & -below).bit_length() - 1) // self._width - 1
+
+    def freeze_faller(self, faller: Faller) -> None:
+        '''
+        Freezes a faller into place.
+        '''
+        for row in faller.rows():
+            self.set_color(row, faller.col(), faller.get_color(row))
+
+    def _journal_changes(self, colors: {str: int}, occupied: int) -> None:
+        '''
+        Journals the old color of every cell that is different from the
+        given color masks and occupied mask.
+        '''
+        for color, mask in colors.items():
+            for row, col in self._cells_in(mask & ~self._colors[color]):
+                self._journal.append((row, col, color))
+        for row, col in self._cells_in(self._occupied & ~occupied):
+            self._journal.append((row, col, BLANK))
+
+    def _run_starts(self, placed: int, shift: int) -> int:
+        '''
+        Returns the cells that a run in the direction of the shift could
+        start from and still go through a placed cell.
+        '''
+        near = placed
+        for step in range(1, self._rules.length()):
+            near |= placed >> (shift*step)
+        return near
+
+    def _find_runs(self, mask: int, shift: int, near: int) -> int:
+        '''
+        Returns the jewels of a color mask that are in a run of at least
+        the match length in the direction of the shift, starting from the
+        near cells.
+        '''
+        length = self._rules.length()
+        starts = mask & near
+        for step in range(1, length):
+            starts &= mask >> (shift*step)
+        runs = starts
+        for step in range(1, length):
+            runs |= starts << (shift*step)
+        return runs
+
+    def _bit(self, row: int, col: int) -> int:
+        '''
+        Returns the bit of a row and column.
+        '''
+        return 1 << (row*self._width + col)
+
+    def _cells_in(self, mask: int) -> [(int, int)]:
+        '''
+        Returns the row and column of every bit in a mask.
+        '''
+        cells = []
+        while mask:
+            low = mask & -mask
+            cells.append(divmod(low.bit_length() - 1, self._width))
+            mask ^= low
+        return cells
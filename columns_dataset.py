@@ -0,0 +1,292 @@
+# columns_dataset.py
+# Exports positions of headless or replayed games to a memory-mapped file of
+# fixed-width records that training jobs can open without parsing.
+import argparse
+import random
+import struct
+import numpy
+import columns_ai
+import columns_model
+import columns_replay
+import columns_runner
+import columns_session
+
+DATASET_MAGIC = b"CDAT"
+DATASET_VERSION = 2
+DATASET_HEADER = struct.Struct("<4sBHHHBQQ")
+RECORD_ALIGNMENT = 64
+INITIAL_CAPACITY = 4096
+NO_ACTION = 0
+NO_FALLER = -1
+
+
+def record_dtype(rows: int, cols: int) -> numpy.dtype:
+    '''
+    Returns the layout of one record for a field of the given size,
+    counting the buffer rows. The board holds the color code of every cell
+    with the faller drawn in, code 0 is blank. The faller column is -1 when
+    there is no faller.
+    '''
+    return numpy.dtype([("board", numpy.uint8, (rows, cols)), ("faller_col", "<i2"),
+                        ("faller_bottom", "<u2"),
+                        ("faller_colors", numpy.uint8, (columns_model.FALLER_LENGTH,)),
+                        ("action", numpy.uint8), ("reward", "<i4"), ("game_over", numpy.bool_)])
+
+
+def _header(rows: int, cols: int, buffer_size: int, colors: [str], records: int) -> bytes:
+    '''
+    Packs the header and the table of colors, padded so that the records
+    start on a RECORD_ALIGNMENT boundary.
+    '''
+    table = b"".join(bytes([len(color.encode())]) + color.encode()
+                     for color in colors)
+    size = DATASET_HEADER.size + len(table)
+    offset = -(-size // RECORD_ALIGNMENT)*RECORD_ALIGNMENT
+    return DATASET_HEADER.pack(DATASET_MAGIC, DATASET_VERSION, rows, cols, buffer_size,
+                               len(colors), records, offset) + table + bytes(offset - size)
+
+
+class DatasetWriter:
+    '''
+    Streams records to a file through a memory map that grows by doubling
+    as it fills up. Each record is a position (the board and faller of a
+    game state), the action taken from it, and the reward and game over
+    state that followed. close() writes the number of records to the
+    header and trims the file.
+    '''
+
+    def __init__(self, path: str, rows: int, cols: int, colors: [str], buffer_size: int = columns_model.BUFFER_SIZE):
+        if len(colors) > 255:
+            raise ValueError("too many colors for uint8 color codes")
+        self._path = path
+        self._rows = rows + buffer_size
+        self._cols = cols
+        self._buffer_size = buffer_size
+        self._colors = list(colors)
+        self._codes = {color: code + 1 for code, color in enumerate(colors)}
+        self._codes[columns_model.BLANK] = 0
+        self._dtype = record_dtype(self._rows, self._cols)
+        self._header = _header(self._rows, cols, buffer_size, self._colors, 0)
+        self._count = 0
+        self._capacity = 0
+        self._records = None
+        with open(path, "wb") as file:
+            file.write(self._header)
+        self._grow(INITIAL_CAPACITY)
+
+    def count(self) -> int:
+        '''
+        Returns the number of records written.
+        '''
+        return self._count
+
+    def write(self, state: columns_model.GameState, action: int) -> None:
+        '''
+        Writes a position and the action taken from it as the next record,
+        with no reward until reward() is called.
+        '''
+        if self._count == self._capacity:
+            self._grow(self._capacity*2)
+        record = self._records[self._count]
+        codes = self._codes
+        record["board"] = [[codes[color] for color in row]
+                           for row in state.render_grid()[1]]
+        faller = state.faller()
+        if faller:
+            record["faller_col"] = faller.col()
+            record["faller_bottom"] = faller.bottom()
+            record["faller_colors"] = [codes[color]
+                                       for color in faller.colors()]
+        else:
+            record["faller_col"] = NO_FALLER
+            record["faller_bottom"] = 0
+            record["faller_colors"] = 0
+        record["action"] = action
+        record["reward"] = 0
+        record["game_over"] = state.game_over()
+        self._count += 1
+
+    def reward(self, reward: int, game_over: bool) -> None:
+        '''
+        Sets the reward and game over state of the last record.
+        '''
+        record = self._records[self._count - 1]
+        record["reward"] = reward
+        record["game_over"] = game_over
+
+    def close(self) -> None:
+        '''
+        Writes the header with the number of records and trims the file to
+        them.
+        '''
+        self._records.flush()
+        self._records = None
+        header = _header(self._rows, self._cols, self._buffer_size,
+                         self._colors, self._count)
+        with open(self._path, "r+b") as file:
+            file.write(header)
+            file.truncate(len(header) + self._count*self._dtype.itemsize)
+
+    def _grow(self, capacity: int) -> None:
+        '''
+        Makes room for the given number of records and maps them again.
+        '''
+        if self._records is not None:
+            self._records.flush()
+            self._records = None
+        with open(self._path, "r+b") as file:
+            file.truncate(len(self._header) + capacity*self._dtype.itemsize)
+        self._records = numpy.memmap(self._path, self._dtype, "r+",
+                                     len(self._header), (capacity,))
+        self._capacity = capacity
+
+
+class Dataset:
+    '''
+    Opens a file made by DatasetWriter. The records are a read-only memory
+    map, so nothing is read until it is used.
+    '''
+
+    def __init__(self, path: str):
+        with open(path, "rb") as file:
+            data = file.read(DATASET_HEADER.size)
+            (magic, version, self._rows, self._cols, self._buffer_size,
+             colors, self._count, offset) = DATASET_HEADER.unpack(data)
+            if magic != DATASET_MAGIC or version != DATASET_VERSION:
+                raise ValueError(f"{path} is not a dataset")
+            self._colors = []
+            for color in range(colors):
+                length = file.read(1)[0]
+                self._colors.append(file.read(length).decode())
+        dtype = record_dtype(self._rows, self._cols)
+        self._records = numpy.memmap(path, dtype, "r", offset, (self._count,)) \
+            if self._count else numpy.zeros(0, dtype)
+
+    def __len__(self) -> int:
+        return self._count
+
+    def rows(self) -> int:
+        '''
+        Returns the number of rows of the boards, counting the buffer.
+        '''
+        return self._rows
+
+    def cols(self) -> int:
+        '''
+        Returns the number of columns of the boards.
+        '''
+        return self._cols
+
+    def buffer_size(self) -> int:
+        '''
+        Returns the number of buffer rows at the top of the boards.
+        '''
+        return self._buffer_size
+
+    def color_table(self) -> [str]:
+        '''
+        Returns the color of each code on the boards, code 0 is blank.
+        '''
+        return [columns_model.BLANK] + self._colors
+
+    def records(self) -> numpy.memmap:
+        '''
+        Returns the records as a structured array laid out by record_dtype.
+        '''
+        return self._records
+
+
+def export_games(path: str, games: int, seed: int = 0, rows: int = columns_runner.ROWS, cols: int = columns_runner.COLUMNS, policy=columns_runner.random_policy, max_ticks: int = columns_runner.MAX_TICKS, rules: columns_model.MatchRules = columns_model.DEFAULT_RULES) -> int:
+    '''
+    Plays games as columns_runner.play_game does and writes one record per
+    update: the position, the policy's input (NO_ACTION for none) and the
+    score gained. Returns the number of records written.
+    '''
+    writer = DatasetWriter(path, rows, cols, columns_model.COLORS)
+    try:
+        for game in range(games):
+            game_seed = columns_runner.derive_seed(seed, game)
+            session = columns_session.GameSession(
+                rows, cols, seed=game_seed, rules=rules)
+            rng = random.Random(game_seed)
+            while not session.game_over() and session.ticks() < max_ticks:
+                score = session.score()
+                action = policy(session, rng)
+                writer.write(session.state(), action or NO_ACTION)
+                if action is not None:
+                    session.handle_input(action)
+                session.update_state()
+                writer.reward(session.score() - score, session.game_over())
+    finally:
+        writer.close()
+    return writer.count()
+
+
+def export_replays(path: str, paths: [str]) -> int:
+    '''
+    Plays replays back and writes one record per input, and per frame
+    without one: the position, the input (NO_ACTION for none) and the score
+    gained. The replays must all have the same board size and colors, or
+    ValueError is raised naming the first one that doesn't.
+    Returns the number of records written.
+    '''
+    writer = None
+    layout = None
+    try:
+        for replay_path in paths:
+            replay = columns_replay.Replay(replay_path)
+            session = replay.new_session()
+            state = session.state()
+            replay_layout = (state.rows(), state.cols(),
+                             state.buffer_size(), list(replay.colors()))
+            if writer is None:
+                writer = DatasetWriter(path, state.rows() - state.buffer_size(),
+                                       state.cols(), replay.colors(), state.buffer_size())
+                layout = replay_layout
+            elif replay_layout != layout:
+                raise ValueError(
+                    f"{replay_path} has a different board size or colors than {paths[0]}")
+            inputs = {}
+            for frame, action in replay.inputs():
+                inputs.setdefault(frame, []).append(action)
+            end = replay.end_frame()
+            if end is None:
+                end = max(inputs, default=0) + 1
+            while session.frames() < end and not session.game_over():
+                actions = inputs.get(session.frames(), [NO_ACTION])
+                for index, action in enumerate(actions):
+                    score = session.score()
+                    writer.write(session.state(), action)
+                    session.handle_input(action)
+                    if index == len(actions) - 1:
+                        session.advance_frame()
+                    writer.reward(session.score() - score, session.game_over())
+    finally:
+        if writer is not None:
+            writer.close()
+    return writer.count() if writer else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Exports positions of columns games to a memory-mapped dataset.")
+    parser.add_argument("output")
+    parser.add_argument("--replays", nargs="+", default=None,
+                        help="replays to export instead of playing new games")
+    parser.add_argument("--games", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--rows", type=int, default=columns_runner.ROWS)
+    parser.add_argument("--cols", type=int, default=columns_runner.COLUMNS)
+    parser.add_argument("--max-ticks", type=int,
+                        default=columns_runner.MAX_TICKS)
+    parser.add_argument("--planner", action="store_true",
+                        help="play with the search planner instead of random inputs")
+    args = parser.parse_args()
+
+    if args.replays:
+        count = export_replays(args.output, args.replays)
+    else:
+        policy = columns_ai.PlannerPolicy() if args.planner else columns_runner.random_policy
+        count = export_games(args.output, args.games, args.seed, args.rows,
+                             args.cols, policy, args.max_ticks)
+    print(f"wrote {count} records to {args.output}")
@@ -0,0 +1,403 @@
+# columns_fuzz.py
+# Plays the same random operations on the reference game state and on the
+# alternative engines, and shrinks any difference to a short repro.
+import argparse
+import concurrent.futures
+import json
+import os
+import random
+import columns_batch
+import columns_bitboard
+import columns_model
+import columns_numpy
+import columns_runner
+
+CONTENTS = "contents"
+FALLER = "faller"
+MOVE = "move"
+ROTATE = "rotate"
+UPDATE = "update"
+HARD_DROP = "hard_drop"
+SETTLE = "settle"
+OPERATION_WEIGHTS = {FALLER: 3, MOVE: 4, ROTATE: 2,
+                     UPDATE: 8, HARD_DROP: 2, SETTLE: 1}
+
+SEQUENCES = 1000
+LENGTH = 300
+BLANK_CHANCE = 0.4
+HISTORY_LENGTH = 1 << 20
+
+
+def random_spec(rng: random.Random) -> dict:
+    '''
+    Picks a board shape, colors and match rules. Few colors are used so
+    that matches and chain reactions are common.
+    '''
+    return {"rows": rng.randint(3, 13), "cols": rng.randint(1, 8),
+            "colors": columns_model.COLORS[:rng.randint(2, 4)],
+            "length": rng.choice((2, 3, 3, 3, 4)),
+            "diagonals": rng.random() < 0.8, "match_buffer": rng.random() < 0.2}
+
+
+def spec_rules(spec: dict) -> columns_model.MatchRules:
+    '''
+    Returns the match rules of a spec.
+    '''
+    return columns_model.MatchRules(spec["length"], spec["diagonals"], spec["match_buffer"])
+
+
+def random_operations(rng: random.Random, spec: dict, length: int) -> [list]:
+    '''
+    Makes a sequence of operations, each a list of its name and arguments
+    so that it can be written out as JSON. Half of the sequences start by
+    filling the field with random contents.
+    '''
+    operations = []
+    if rng.random() < 0.5:
+        operations.append([CONTENTS, [[columns_model.BLANK if rng.random() < BLANK_CHANCE else rng.choice(spec["colors"])
+                                       for col in range(spec["cols"])] for row in range(spec["rows"])]])
+    names = list(OPERATION_WEIGHTS)
+    weights = list(OPERATION_WEIGHTS.values())
+    while len(operations) < length:
+        name = rng.choices(names, weights)[0]
+        if name == FALLER:
+            operations.append([FALLER, rng.randrange(spec["cols"]),
+                               [rng.choice(spec["colors"]) for jewel in range(columns_model.FALLER_LENGTH)]])
+        elif name == MOVE:
+            operations.append(
+                [MOVE, rng.choice((columns_model.LEFT, columns_model.RIGHT))])
+        else:
+            operations.append([name])
+    return operations
+
+
+class StateEngine:
+    '''
+    Plays operations on a columns_model.GameState. Without shortcuts it is
+    the reference: hard drops and chain reactions are played out one
+    update at a time. With shortcuts they use hard_drop and
+    resolve_cascade. A round trip of "clone" or "bytes" replaces the state
+    with a copy after every operation, and undo undoes and redoes every
+    operation, to check those against the reference as well.
+    '''
+
+    def __init__(self, spec: dict, field_class: type = columns_model.Field, shortcuts: bool = True, round_trip: str = None, undo: bool = False):
+        self._spec = spec
+        self._field_class = field_class
+        self._shortcuts = shortcuts
+        self._round_trip = round_trip
+        self._undo = undo
+        self._state = columns_model.GameState(field_class, spec_rules(spec))
+        self._state.initialize_field(spec["rows"], spec["cols"])
+        if undo:
+            self._state.set_history(HISTORY_LENGTH)
+
+    def apply(self, operation: list) -> None:
+        '''
+        Plays an operation.
+        '''
+        history = self._state.history_length()
+        self._play(operation)
+        if self._undo and self._state.history_length() > history:
+            self._state.undo()
+            self._play(operation)
+        if self._round_trip == "clone":
+            self._state = self._state.clone()
+        elif self._round_trip == "bytes":
+            self._state = columns_model.GameState.from_bytes(
+                self._state.to_bytes(), self._field_class, spec_rules(self._spec))
+
+    def observe(self) -> tuple:
+        '''
+        Returns the colors of every cell with the faller drawn in, the
+        matching jewels, the faller and the game over state.
+        '''
+        state = self._state
+        faller = state.faller()
+        return (tuple(tuple(row) for row in state.render_grid()[1]), tuple(sorted(state.matching())),
+                (faller.col(), tuple(faller.rows()), tuple(faller.colors())) if faller else None,
+                state.game_over())
+
+    def _play(self, operation: list) -> None:
+        '''
+        Plays an operation on the state.
+        '''
+        state = self._state
+        name = operation[0]
+        if name == CONTENTS:
+            state.initialize_contents(operation[1])
+        elif name == FALLER:
+            state.initialize_faller(operation[1], list(operation[2]))
+        elif name == MOVE:
+            state.move_faller(operation[1])
+        elif name == ROTATE:
+            state.rotate_faller()
+        elif name == UPDATE:
+            state.update()
+        elif name == HARD_DROP and self._shortcuts:
+            state.hard_drop()
+        elif name == HARD_DROP:
+            if not state.game_over():
+                while state.faller():
+                    state.update()
+        elif name == SETTLE and self._shortcuts:
+            state.resolve_cascade()
+        elif name == SETTLE:
+            while state.matching() and not state.game_over():
+                state.update()
+
+
+class EventEngine(StateEngine):
+    '''
+    Plays operations on a game state but observes a copy of the board that
+    is only kept up to date by the state's change events.
+    '''
+
+    def __init__(self, spec: dict):
+        super().__init__(spec)
+        self._read_state()
+        self._state.subscribe(self._apply_events)
+
+    def observe(self) -> tuple:
+        '''
+        Returns the same as StateEngine.observe, built from the events.
+        '''
+        colors = [row[:] for row in self._colors]
+        if self._faller:
+            col, rows, faller_colors = self._faller
+            for row, color in zip(rows, faller_colors):
+                colors[row][col] = color
+        return (tuple(tuple(row) for row in colors), tuple(sorted(self._matching)),
+                self._faller, self._game_over)
+
+    def _read_state(self) -> None:
+        '''
+        Reads the whole state again.
+        '''
+        faller = self._state.faller()
+        self._colors = [list(row) for row in self._state.render_grid()[1]]
+        self._faller = None
+        if faller:
+            self._faller = (faller.col(), tuple(faller.rows()),
+                            tuple(faller.colors()))
+            for row in faller.rows():
+                self._colors[row][faller.col()] = columns_model.BLANK
+        self._matching = set(self._state.matching())
+        self._game_over = self._state.game_over()
+
+    def _apply_events(self, events: [(str, object)]) -> None:
+        '''
+        Applies the changes of a list of events to the copy.
+        '''
+        for kind, data in events:
+            if kind == columns_model.RESET:
+                self._read_state()
+            elif kind == columns_model.FROZEN:
+                for row, col, color in data:
+                    self._colors[row][col] = color
+                self._faller = None
+            elif kind == columns_model.CLEARED:
+                for row, col in data:
+                    self._colors[row][col] = columns_model.BLANK
+                self._matching.difference_update(data)
+            elif kind == columns_model.DROPPED:
+                moved = [(col, new_row, self._colors[old_row][col])
+                         for col, old_row, new_row in data]
+                for col, old_row, new_row in data:
+                    self._colors[old_row][col] = columns_model.BLANK
+                for col, new_row, color in moved:
+                    self._colors[new_row][col] = color
+            elif kind == columns_model.MATCHED:
+                self._matching.update(data)
+            elif kind == columns_model.GAME_ENDED:
+                self._game_over = True
+            else:
+                col, rows, colors, landed = data
+                self._faller = (col, tuple(rows), tuple(colors))
+
+
+class BatchEngine:
+    '''
+    Plays operations on a one game columns_batch.BatchGameState that only
+    gets fallers from the operations.
+    '''
+
+    def __init__(self, spec: dict):
+        self._batch = columns_batch.BatchGameState(1, spec["rows"], spec["cols"], spec["colors"],
+                                                   rules=spec_rules(spec), auto_fallers=False)
+
+    def apply(self, operation: list) -> None:
+        '''
+        Plays an operation.
+        '''
+        batch = self._batch
+        name = operation[0]
+        if name == CONTENTS:
+            batch.initialize_contents(0, operation[1])
+        elif name == FALLER:
+            batch.initialize_faller(0, operation[1], operation[2])
+        elif name == MOVE:
+            batch.apply([columns_batch.MOVE_LEFT if operation[1] ==
+                         columns_model.LEFT else columns_batch.MOVE_RIGHT])
+        elif name == ROTATE:
+            batch.apply([columns_batch.ROTATE])
+        elif name == UPDATE:
+            batch.step([columns_batch.NOOP])
+        elif name == HARD_DROP:
+            if batch.faller(0) is not None:
+                batch.step([columns_batch.DROP])
+        elif name == SETTLE:
+            while batch.matching()[0].any() and not batch.game_over()[0]:
+                batch.step([columns_batch.NOOP])
+
+    def observe(self) -> tuple:
+        '''
+        Returns the same as StateEngine.observe.
+        '''
+        table = self._batch.color_table()
+        faller = self._batch.faller(0)
+        return (tuple(tuple(table[code] for code in row) for row in self._batch.boards()[0].tolist()),
+                tuple((row, col) for row, col in zip(
+                    *(indices.tolist() for indices in self._batch.matching()[0].nonzero()))),
+                (faller[0], tuple(faller[1]), tuple(faller[2])) if faller else None,
+                bool(self._batch.game_over()[0]))
+
+
+ENGINES = {
+    "list": lambda spec: StateEngine(spec),
+    "bitboard": lambda spec: StateEngine(spec, columns_bitboard.BitboardField),
+    "numpy": lambda spec: StateEngine(spec, columns_numpy.NumpyField),
+    "clone": lambda spec: StateEngine(spec, round_trip="clone"),
+    "bytes": lambda spec: StateEngine(spec, round_trip="bytes"),
+    "undo": lambda spec: StateEngine(spec, undo=True),
+    "events": EventEngine,
+    "batch": BatchEngine,
+}
+
+
+def find_divergence(spec: dict, operations: [list], engines: [str]) -> dict:
+    '''
+    Plays the operations on the reference and the named engines, comparing
+    them after every operation until the reference's game is over. Returns
+    the first difference (or exception), or None if they all agree.
+    '''
+    reference = StateEngine(spec, shortcuts=False)
+    others = [(name, ENGINES[name](spec)) for name in engines]
+    for step, operation in enumerate(operations):
+        reference.apply(operation)
+        expected = reference.observe()
+        for name, engine in others:
+            try:
+                engine.apply(operation)
+                actual = engine.observe()
+            except Exception as error:
+                return {"step": step, "engine": name, "error": repr(error)}
+            if actual != expected:
+                return {"step": step, "engine": name, "expected": expected, "actual": actual}
+        if expected[-1]:
+            break
+    return None
+
+
+def shrink(spec: dict, operations: [list], engine: str) -> [list]:
+    '''
+    Returns a shorter sequence of operations that still makes the engine
+    differ from the reference: everything after the difference is cut,
+    then chunks of operations, halving in size down to one, are removed
+    while it still differs, then the cells of starting contents are
+    blanked while it still differs.
+    '''
+    def diverges(candidate: [list]) -> int:
+        found = find_divergence(spec, candidate, [engine])
+        return found["step"] + 1 if found else 0
+
+    operations = operations[:diverges(operations)]
+    chunk = max(1, len(operations) // 2)
+    while chunk >= 1:
+        index = 0
+        while index < len(operations):
+            candidate = operations[:index] + operations[index + chunk:]
+            end = diverges(candidate)
+            if end:
+                operations = candidate[:end]
+            else:
+                index += chunk
+        chunk //= 2
+
+    for index, operation in enumerate(operations):
+        if operation[0] != CONTENTS:
+            continue
+        for row in range(len(operation[1])):
+            for col in range(len(operation[1][row])):
+                if operation[1][row][col] == columns_model.BLANK:
+                    continue
+                contents = [cells[:] for cells in operation[1]]
+                contents[row][col] = columns_model.BLANK
+                candidate = operations[:index] + \
+                    [[CONTENTS, contents]] + operations[index + 1:]
+                if diverges(candidate):
+                    operations = candidate
+                    operation = candidate[index]
+    return operations
+
+
+def fuzz_sequence(seed: int, length: int = LENGTH, engines: [str] = tuple(ENGINES)) -> dict:
+    '''
+    Plays one random sequence made from a seed on every engine. Returns
+    None if they all agree with the reference, or the difference along
+    with the shrunk sequence that reproduces it.
+    '''
+    rng = random.Random(seed)
+    spec = random_spec(rng)
+    operations = random_operations(rng, spec, length)
+    divergence = find_divergence(spec, operations, engines)
+    if divergence is None:
+        return None
+    operations = shrink(spec, operations, divergence["engine"])
+    return {"seed": seed, "spec": spec, "operations": operations,
+            "divergence": find_divergence(spec, operations, [divergence["engine"]])}
+
+
+def run_fuzz(sequences: int, seed: int = 0, length: int = LENGTH, engines: [str] = tuple(ENGINES), workers: int = None) -> [dict]:
+    '''
+    Plays a number of random sequences across a process pool and returns
+    the differences found.
+    '''
+    seeds = [columns_runner.derive_seed(seed, sequence)
+             for sequence in range(sequences)]
+    workers = workers or os.cpu_count() or 1
+    chunksize = max(1, sequences // (4*workers))
+    with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+        results = executor.map(fuzz_sequence, seeds, [length]*sequences,
+                               [tuple(engines)]*sequences, chunksize=chunksize)
+        return [result for result in results if result is not None]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Checks alternative columns engines against the reference game state.")
+    parser.add_argument("--sequences", type=int, default=SEQUENCES)
+    parser.add_argument("--length", type=int, default=LENGTH,
+                        help="operations in each sequence")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--engines", default=",".join(ENGINES),
+                        help=f"comma separated engines to check, out of {', '.join(ENGINES)}")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--output", default=None,
+                        help="file to write the shrunk repros to")
+    args = parser.parse_args()
+
+    engines = args.engines.split(",")
+    for engine in engines:
+        if engine not in ENGINES:
+            parser.error(f"unknown engine {engine}")
+    failures = run_fuzz(args.sequences, args.seed,
+                        args.length, engines, args.workers)
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(failures, file, indent=2)
+    for failure in failures:
+        print(json.dumps({key: failure[key] for key in ("seed", "spec", "operations")}))
+        print(f"  {failure['divergence']}")
+    print(f"{args.sequences - len(failures)} of {args.sequences} sequences agreed")
+    raise SystemExit(1 if failures else 0)
@@ -1,5 +1,9 @@
 # columns_model.py
 # Holds all the logic of the columns game.
+import functools
+import struct
+import time
+from collections import deque
 
 COLORS = ['S', 'T', 'V', 'W', 'X', 'Y', 'Z']
 BLANK = " "
@@ -19,6 +23,106 @@ MATCHING_LENGTH = 3
 
 DEBUG_MODE = False
 
+SNAPSHOT_MAGIC = b"COLS"
+SNAPSHOT_VERSION = 1
+SNAPSHOT_HEADER = struct.Struct("<4sBHHHBHHBB")
+GAME_OVER_FLAG = 1
+FALLER_FLAG = 2
+
+RESET = "reset"
+FROZEN = "frozen"
+CLEARED = "cleared"
+DROPPED = "dropped"
+MATCHED = "matched"
+FALLER_CREATED = "faller_created"
+FALLER_MOVED = "faller_moved"
+FALLER_ROTATED = "faller_rotated"
+FALLER_DROPPED = "faller_dropped"
+GAME_ENDED = "game_over"
+
+
+class MatchRules:
+    '''
+    Describes which jewels match: runs of at least length jewels of the
+    same color, horizontally, vertically and, with diagonals, diagonally.
+    Jewels in the buffer rows don't match unless match_buffer is set.
+    '''
+
+    def __init__(self, length: int = MATCHING_LENGTH, diagonals: bool = True, match_buffer: bool = False):
+        if length < 1:
+            raise ValueError("match length must be at least 1")
+        self._length = length
+        self._diagonals = diagonals
+        self._match_buffer = match_buffer
+
+    def length(self) -> int:
+        '''
+        Returns the shortest run that matches.
+        '''
+        return self._length
+
+    def diagonals(self) -> bool:
+        '''
+        Returns whether diagonal runs match.
+        '''
+        return self._diagonals
+
+    def match_buffer(self) -> bool:
+        '''
+        Returns whether jewels in the buffer rows can match.
+        '''
+        return self._match_buffer
+
+    def directions(self) -> [(int, int)]:
+        '''
+        Returns the row and column steps of the directions runs go in.
+        '''
+        if self._diagonals:
+            return [(0, 1), (1, 0), (1, 1), (1, -1)]
+        return [(0, 1), (1, 0)]
+
+    def first_row(self, buffer_size: int) -> int:
+        '''
+        Returns the first row of a field with a buffer that can match.
+        '''
+        return 0 if self._match_buffer else buffer_size
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, MatchRules) and self._key() == other._key()
+
+    def __hash__(self) -> int:
+        return hash(self._key())
+
+    def __repr__(self) -> str:
+        return f"MatchRules(length={self._length}, diagonals={self._diagonals}, match_buffer={self._match_buffer})"
+
+    def _key(self) -> tuple:
+        return (self._length, self._diagonals, self._match_buffer)
+
+
+DEFAULT_RULES = MatchRules()
+
+
+@functools.lru_cache(maxsize=None)
+def line_segments(rows: int, cols: int, buffer_size: int, rules: MatchRules) -> ((((int, int),),),):
+    '''
+    Returns, for every row and column, the segments of rules.length()
+    cells in every direction that the cell is part of and that lie in the
+    rows that can match. The table is built once for every board shape and
+    set of rules.
+    '''
+    first_row = rules.first_row(buffer_size)
+    length = rules.length()
+    segments = [[[] for col in range(cols)] for row in range(rows)]
+    for drow, dcol in rules.directions():
+        for row in range(first_row, rows - drow*(length - 1)):
+            for col in range(max(0, -dcol*(length - 1)), min(cols, cols - dcol*(length - 1))):
+                segment = tuple((row + drow*step, col + dcol*step)
+                                for step in range(length))
+                for cell_row, cell_col in segment:
+                    segments[cell_row][cell_col].append(segment)
+    return tuple(tuple(tuple(cell) for cell in row) for row in segments)
+
 
 class Faller:
     '''
@@ -48,11 +152,17 @@ class Faller:
         '''
         return self._rows
 
+    def colors(self) -> [str]:
+        '''
+        Returns the colors of the faller from top to bottom.
+        '''
+        return self._colors
+
     def get_color(self, row: int) -> str:
         '''
         Returns the color of the jewel in the given row.
         '''
-        return self._colors[self._rows.index(row)]
+        return self._colors[row - self._rows[0]]
 
     def move(self, direction: int) -> None:
         '''
@@ -60,11 +170,11 @@ class Faller:
         '''
         self._col += direction
 
-    def drop(self) -> None:
+    def drop(self, distance: int = 1) -> None:
         '''
-        Moves the faller down one.
+        Moves the faller down by a distance, one row by default.
         '''
-        self._rows = [row + 1 for row in self._rows]
+        self._rows = [row + distance for row in self._rows]
 
     def rotate(self) -> None:
         '''
@@ -79,19 +189,37 @@ class Faller:
         '''
         return col == self._col and row in self._rows
 
+    def clone(self) -> 'Faller':
+        '''
+        Returns a copy of the faller.
+        '''
+        faller = Faller.__new__(Faller)
+        faller._col = self._col
+        faller._rows = self._rows[:]
+        faller._colors = self._colors[:]
+        return faller
+
 
 class Field:
     '''
-    Stores the data of the field.
+    Stores the data of the field. Matches are found with the line segment
+    table of the board shape and match rules.
     '''
 
-    def __init__(self, rows: int, cols: int, buffer_size: int):
+    def __init__(self, rows: int, cols: int, buffer_size: int, rules: MatchRules = DEFAULT_RULES):
         self._rows = rows+buffer_size
         self._cols = cols
         self._buffer_size = buffer_size
+        self._rules = rules
+        self._segments = line_segments(self._rows, cols, buffer_size, rules)
         self._cells = [[BLANK for col in range(
             self._cols)] for row in range(self._rows)]
-        self._matching = []
+        self._matching = set()
+        self._dirty = set()
+        self._tops = [self._rows]*self._cols
+        self._counts = [0]*self._cols
+        self._unsettled = set()
+        self._journal = None
 
     def rows(self) -> int:
         '''
@@ -111,7 +239,13 @@ class Field:
         '''
         return self._buffer_size
 
-    def matching(self) -> [(int, int)]:
+    def rules(self) -> MatchRules:
+        '''
+        Returns the match rules.
+        '''
+        return self._rules
+
+    def matching(self) -> {(int, int)}:
         '''
         Returns the matching jewel positions.
         '''
@@ -123,28 +257,75 @@ class Field:
         '''
         return self._cells[row][col]
 
+    def get_row(self, row: int) -> [str]:
+        '''
+        Gets a copy of the colors of a row.
+        '''
+        return self._cells[row][:]
+
+    def clone(self) -> 'Field':
+        '''
+        Returns a copy of the field.
+        '''
+        field = Field.__new__(Field)
+        field._rows = self._rows
+        field._cols = self._cols
+        field._buffer_size = self._buffer_size
+        field._rules = self._rules
+        field._segments = self._segments
+        field._cells = [row[:] for row in self._cells]
+        field._matching = set(self._matching)
+        field._dirty = set(self._dirty)
+        field._tops = self._tops[:]
+        field._counts = self._counts[:]
+        field._unsettled = set(self._unsettled)
+        field._journal = None
+        return field
+
     def set_color(self, row: int, col: int, val: str) -> None:
         '''
         Sets a color for a row and column.
         '''
-        self._cells[row][col] = val
+        self._set(row, col, val)
+
+    def set_matching(self, matching: [(int, int)]) -> None:
+        '''
+        Replaces the matching jewel positions.
+        '''
+        self._matching = set(matching)
+
+    def set_journal(self, journal: list) -> None:
+        '''
+        Sets a list that every change to a cell is appended to as the row,
+        column and old color, or None to stop.
+        '''
+        self._journal = journal
 
     def clear_matching(self) -> None:
         '''
-        Removes the matching blocks and then empties the list.
+        Removes the matching blocks and then empties the set.
         '''
         for row, col in self._matching:
-            self._cells[row][col] = BLANK
-        self._matching = []
+            self._set(row, col, BLANK)
+        self._matching = set()
 
     def drop_field(self) -> None:
         '''
-        Instantly drops all pieces in the field.
+        Instantly drops all pieces in the field. Only the columns written
+        to since the last drop can have gaps, so the others are skipped.
         '''
-        for col in range(self._cols):
+        for col in sorted(self._unsettled):
             dropped_column = self._get_dropped_column(col)
             for row in range(self._rows):
-                self._cells[row][col] = dropped_column[row]
+                if self._cells[row][col] != dropped_column[row]:
+                    if self._journal is not None:
+                        self._journal.append((row, col, self._cells[row][col]))
+                    self._cells[row][col] = dropped_column[row]
+                    self._dirty.add((row, col))
+            top = self._rows - sum(color != BLANK for color in dropped_column)
+            self._tops[col] = top
+            self._counts[col] = self._rows - max(top, self._buffer_size)
+        self._unsettled = set()
 
     def _get_dropped_column(self, col: int) -> [str]:
         '''
@@ -157,16 +338,21 @@ class Field:
 
     def locate_matching(self) -> None:
         '''
-        Finds all matching jewels in all directions and then adds them to 
-        the matching jewels list.
-        '''
-        for row in range(len(self._cells)):
-            for col in range(len(self._cells[row])):
-                if self._cells[row][col] != BLANK:
-                    self._add_matching(row, col, 0, 1)
-                    self._add_matching(row, col, 1, 0)
-                    self._add_matching(row, col, 1, 1)
-                    self._add_matching(row, col, 1, -1)
+        Finds the segments passing through the cells changed since the last
+        scan that are all one color and then adds their jewels to the
+        matching jewels set.
+        '''
+        cells = self._cells
+        for row, col in self._dirty:
+            color = cells[row][col]
+            if color != BLANK:
+                for segment in self._segments[row][col]:
+                    for segment_row, segment_col in segment:
+                        if cells[segment_row][segment_col] != color:
+                            break
+                    else:
+                        self._matching.update(segment)
+        self._dirty = set()
 
     def matching_contains_cell(self, row: int, col: int) -> bool:
         '''
@@ -178,21 +364,17 @@ class Field:
         '''
         Checks if a column is full.
         '''
-        return all([self._cells[row][col] != BLANK for row in range(self._buffer_size, self._rows)])
+        return self._counts[col] == self._rows - self._buffer_size
 
     def empty_buffer(self) -> bool:
         '''
         Checks if the buffer is empty.
         '''
-        for row in range(self._buffer_size):
-            for col in range(self._cols):
-                if self._cells[row][col] != BLANK:
-                    return False
-        return True
+        return min(self._tops) >= self._buffer_size
 
     def no_matching(self) -> bool:
         '''
-        Checks if the matching jewels list is empty.
+        Checks if the matching jewels set is empty.
         '''
         return len(self._matching) == 0
 
@@ -200,7 +382,9 @@ class Field:
         '''
         Checks if a column is empty.
         '''
-        return not col < 0 and not col > self._cols - 1 and all([self._cells[row][col] == BLANK for row in rows])
+        if col < 0 or col > self._cols - 1:
+            return False
+        return max(rows) < self._tops[col] or all([self._cells[row][col] == BLANK for row in rows])
 
     def is_landed(self, row: int, col: int) -> bool:
         '''
@@ -208,58 +392,101 @@ class Field:
         '''
         return row == self._rows - 1 or self._cells[row + 1][col] != BLANK
 
+    def landing_row(self, row: int, col: int) -> int:
+        '''
+        Returns the row a jewel falling from a row in a column lands on.
+        '''
+        if row < self._tops[col]:
+            return self._tops[col] - 1
+        while not self.is_landed(row, col):
+            row += 1
+        return row
+
     def freeze_faller(self, faller: Faller) -> None:
         '''
         Freezes a faller into place.
         '''
         for row in faller.rows():
-            self._cells[row][faller.col()] = faller.get_color(row)
+            self._set(row, faller.col(), faller.get_color(row))
 
-    def _add_matching(self, row: int, col: int, drow: int, dcol: int) -> None:
+    def _set(self, row: int, col: int, val: str) -> None:
         '''
-        Adds matching jewels in a particular vector to the matching jewels
-        list.
+        Sets a color for a row and column, keeping track of the changed
+        cells and columns, the top jewel of each column and how full each
+        column is, and journals the old color.
         '''
-        matching = []
-        base_color = self._cells[row][col]
-        while row >= BUFFER_SIZE and col >= 0 and row < self._rows and col < self._cols:
-            if self._cells[row][col] == base_color:
-                matching.append((row, col))
-            else:
-                break
-            row += drow
-            col += dcol
-        if len(matching) >= MATCHING_LENGTH:
-            for match in matching:
-                if match not in self._matching:
-                    self._matching.append(match)
+        old = self._cells[row][col]
+        if old == val:
+            return
+        if self._journal is not None:
+            self._journal.append((row, col, old))
+        self._cells[row][col] = val
+        self._dirty.add((row, col))
+        self._unsettled.add(col)
+        if row >= self._buffer_size:
+            self._counts[col] += (val != BLANK) - (old != BLANK)
+        if val != BLANK:
+            self._tops[col] = min(self._tops[col], row)
+        elif row == self._tops[col]:
+            while row < self._rows and self._cells[row][col] == BLANK:
+                row += 1
+            self._tops[col] = row
 
 
 class GameState:
     '''
-    Stores the game state of the game.
+    Stores the game state of the game. The field_class can be any class
+    with the same interface as Field, such as columns_bitboard.BitboardField,
+    and its fields are made with the given match rules.
+
+    Subscribers are called with the list of events of every change, each a
+    kind and its data:
+        RESET: None, the whole state has to be read again
+        FROZEN: (row, col, color) of every faller jewel frozen into the field
+        CLEARED: (row, col) of every matching jewel removed
+        DROPPED: (col, old row, new row) of every jewel that fell
+        MATCHED: (row, col) of every jewel that started matching
+        FALLER_CREATED, FALLER_MOVED, FALLER_ROTATED, FALLER_DROPPED:
+            (col, rows, colors, landed) of the faller afterwards
+        GAME_ENDED: None
     '''
 
-    def __init__(self):
+    def __init__(self, field_class: type = Field, rules: MatchRules = DEFAULT_RULES):
+        self._field_class = field_class
+        self._rules = rules
         self._faller = None
         self._field = None
         self._game_over = False
+        self._timer = None
+        self._grid = None
+        self._history = None
+        self._journal = None
+        self._subscribers = []
+        self._events = []
 
     def initialize_field(self, rows: int, cols: int) -> None:
         '''
         Initializes the field attribute given a number of rows and columns.
         '''
-        self._field = Field(rows, cols, BUFFER_SIZE)
+        self._field = self._field_class(rows, cols, BUFFER_SIZE, self._rules)
+        self._grid = None
+        if self._history is not None:
+            self._history.clear()
+        self._emit(RESET, None)
+        self._publish()
 
     def initialize_contents(self, contents: [[str]]) -> None:
         '''
         Initializes the contents of the field givena set of nested list
         of colors.
         '''
+        self._remember()
         for row in range(len(contents)):
             for col in range(len(contents[row])):
                 self._field.set_color(row+BUFFER_SIZE, col, contents[row][col])
         self._update_matching()
+        self._emit(RESET, None)
+        self._publish()
 
     def rows(self) -> int:
         '''
@@ -279,12 +506,193 @@ class GameState:
         '''
         return self._field.buffer_size()
 
-    def matching(self) -> int:
+    def rules(self) -> MatchRules:
+        '''
+        Returns the match rules.
+        '''
+        return self._rules
+
+    def matching(self) -> {(int, int)}:
         return self._field.matching()
 
+    def set_timer(self, timer) -> None:
+        '''
+        Sets a timer (such as columns_timing.PhaseTimer) to record how long
+        the clear, drop and match phases of each update take, or None to
+        stop timing.
+        '''
+        self._timer = timer
+
+    def set_history(self, length: int) -> None:
+        '''
+        Keeps the changes made by the last length updates, moves, rotations
+        and new fallers so that they can be undone, or stops keeping them
+        if the length is 0. Only the cells that changed are kept, along with
+        the faller and matching jewels from before each change.
+        '''
+        self._history = deque(maxlen=length) if length > 0 else None
+        self._detach_journal()
+
+    def subscribe(self, subscriber) -> None:
+        '''
+        Calls the subscriber with the list of events of every change from
+        now on.
+        '''
+        self._subscribers.append(subscriber)
+
+    def unsubscribe(self, subscriber) -> None:
+        '''
+        Stops calling a subscriber, and stops journaling cells once nothing
+        needs them.
+        '''
+        self._subscribers.remove(subscriber)
+        if self._history is None and not self._subscribers:
+            self._detach_journal()
+
+    def history_length(self) -> int:
+        '''
+        Returns the number of changes that can be undone.
+        '''
+        return len(self._history) if self._history is not None else 0
+
+    def undo(self, steps: int = 1) -> int:
+        '''
+        Undoes the last steps changes, as many as the history has. Returns
+        the number of changes undone.
+        '''
+        undone = 0
+        if self._history:
+            self._journal = None
+            self._field.set_journal(None)
+        while undone < steps and self._history:
+            changes, faller, matching, game_over = self._history.pop()
+            for row, col, color in reversed(changes):
+                self._field.set_color(row, col, color)
+            self._field.set_matching(matching)
+            if faller:
+                col, top, colors = faller
+                self._faller = Faller(col, colors, len(colors))
+                self._faller.drop(top)
+            else:
+                self._faller = None
+            self._game_over = game_over
+            self._grid = None
+            undone += 1
+        if undone:
+            self._emit(RESET, None)
+            self._publish()
+        return undone
+
+    def clone(self) -> 'GameState':
+        '''
+        Returns a copy of the game state.
+        '''
+        state = GameState.__new__(GameState)
+        state._field_class = self._field_class
+        state._rules = self._rules
+        state._faller = self._faller.clone() if self._faller else None
+        state._field = self._field.clone()
+        state._game_over = self._game_over
+        state._timer = self._timer
+        state._grid = self._grid
+        state._history = None
+        state._journal = None
+        state._subscribers = []
+        state._events = []
+        return state
+
+    def to_bytes(self) -> bytes:
+        '''
+        Packs the game state into bytes: a header, the table of colors, the
+        faller colors and the color code of every cell, two cells to a byte
+        when there are fewer than 16 codes. The matching jewels are not
+        stored since they are found again from the cells.
+        '''
+        palette = [BLANK]
+        codes = {BLANK: 0}
+
+        def code(color: str) -> int:
+            if color not in codes:
+                codes[color] = len(palette)
+                palette.append(color)
+            return codes[color]
+
+        cells = [code(self._field.get_color(row, col)) for row in range(
+            self.rows()) for col in range(self.cols())]
+        faller_colors = [code(color)
+                         for color in self._faller.colors()] if self._faller else []
+        if len(palette) > 255:
+            raise ValueError("too many colors to pack the game state")
+
+        flags = (GAME_OVER_FLAG if self._game_over else 0) | (
+            FALLER_FLAG if self._faller else 0)
+        data = bytearray(SNAPSHOT_HEADER.pack(
+            SNAPSHOT_MAGIC, SNAPSHOT_VERSION, self.rows() - self.buffer_size(), self.cols(),
+            self.buffer_size(), flags, self._faller.col() if self._faller else 0,
+            self._faller.bottom() if self._faller else 0, len(faller_colors), len(palette) - 1))
+        for color in palette[1:]:
+            encoded = color.encode()
+            data.append(len(encoded))
+            data += encoded
+        data += bytes(faller_colors)
+        if len(palette) < 16:
+            cells.append(0)
+            data += bytes((cells[i] << 4) | cells[i + 1]
+                          for i in range(0, len(cells) - 1, 2))
+        else:
+            data += bytes(cells)
+        return bytes(data)
+
+    @classmethod
+    def from_bytes(cls, data: bytes, field_class: type = Field, rules: MatchRules = DEFAULT_RULES) -> 'GameState':
+        '''
+        Creates a game state from bytes made by to_bytes. The match rules
+        aren't stored in the bytes, so they have to be given again.
+        '''
+        (magic, version, rows, cols, buffer_size, flags, faller_col, faller_bottom,
+         faller_length, colors) = SNAPSHOT_HEADER.unpack_from(data)
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+            raise ValueError("not a game state snapshot")
+        if buffer_size != BUFFER_SIZE:
+            raise ValueError(f"snapshot has a buffer of {buffer_size} rows")
+
+        offset = SNAPSHOT_HEADER.size
+        palette = [BLANK]
+        for color in range(colors):
+            length = data[offset]
+            palette.append(data[offset + 1:offset + 1 + length].decode())
+            offset += 1 + length
+        faller_colors = [palette[code]
+                         for code in data[offset:offset + faller_length]]
+        offset += faller_length
+        if len(palette) < 16:
+            cells = [code for byte in data[offset:]
+                     for code in (byte >> 4, byte & 15)]
+        else:
+            cells = data[offset:]
+
+        state = cls(field_class, rules)
+        state.initialize_field(rows, cols)
+        for index in range((rows + buffer_size)*cols):
+            if cells[index]:
+                state._field.set_color(
+                    index // cols, index % cols, palette[cells[index]])
+        state._field.locate_matching()
+        if flags & FALLER_FLAG:
+            state._faller = Faller(faller_col, faller_colors, faller_length)
+            state._faller.drop(faller_bottom - (faller_length - 1))
+        state._game_over = bool(flags & GAME_OVER_FLAG)
+        return state
+
     def no_faller(self) -> bool:
         return self._faller == None
 
+    def faller(self) -> Faller:
+        '''
+        Returns the faller, or None if there is none.
+        '''
+        return self._faller
+
     def get_type(self, row: int, col: int) -> int:
         '''
         Gets the type of cell from the field or faller.
@@ -309,45 +717,126 @@ class GameState:
             return self._faller.get_color(row)
         return self._field.get_color(row, col)
 
+    def render_grid(self) -> ([[int]], [[str]]):
+        '''
+        Returns the type and color of every cell, as get_type and get would,
+        built in one pass over the field. The grids are kept until the state
+        changes, so the same lists are returned until then and must not be
+        modified.
+        '''
+        if self._grid is None:
+            colors = [self._field.get_row(row) for row in range(self.rows())]
+            types = [[NONE if color == BLANK else JEWEL for color in row]
+                     for row in colors]
+            for row, col in self._field.matching():
+                types[row][col] = MATCHING
+            if self._faller:
+                faller_type = LANDED if self._check_faller_landed() else FALLER
+                col = self._faller.col()
+                for row, color in zip(self._faller.rows(), self._faller.colors()):
+                    types[row][col] = faller_type
+                    colors[row][col] = color
+            self._grid = (types, colors)
+        return self._grid
+
     def update(self) -> None:
         '''
         Updates the game state.
         '''
+        self._remember()
+        self._update()
+        self._publish()
+
+    def _update(self) -> None:
+        '''
+        Updates the game state without adding to the history or publishing
+        the events.
+        '''
+        self._grid = None
 
         if self._faller:
             if self._check_faller_landed():
+                if self._subscribers:
+                    self._emit(FROZEN, [(row, self._faller.col(), self._faller.get_color(row))
+                                        for row in self._faller.rows()])
                 self._field.freeze_faller(self._faller)
                 self._faller = None
             else:
                 self._faller.drop()
+                self._emit_faller(FALLER_DROPPED)
         self._update_matching()
         if self._field.no_matching() and not self._field.empty_buffer():
             self._lose_game()
 
+    def resolve_cascade(self) -> [[(int, int)]]:
+        '''
+        Clears, drops and matches the field again until nothing matches,
+        the same as updating until the chain reaction is over but in one
+        call. The faller, if any, is left where it is. Returns the jewels
+        cleared by each link of the chain, so the chain length is the
+        length of the list. Ends the game if the buffer isn't empty
+        afterwards.
+        '''
+        self._remember()
+        chain = []
+        while not self._field.no_matching():
+            chain.append(list(self._field.matching()))
+            self._update_matching()
+        if not self._field.empty_buffer():
+            self._lose_game()
+        self._publish()
+        return chain
+
     def initialize_faller(self, col: int, colors: [str]) -> None:
         '''
         Creates a faller and assigns it, ends the game if not possible.
         '''
         if self._faller == None and self._field.no_matching():
+            self._remember()
             if self._field.column_full(col):
                 self._lose_game()
             else:
                 self._faller = Faller(
                     col, colors, FALLER_LENGTH)
+                self._grid = None
+                self._emit_faller(FALLER_CREATED)
+            self._publish()
+
+    def hard_drop(self) -> None:
+        '''
+        Drops the faller straight to where it lands and freezes it, the same
+        as updating until it has landed and then once more.
+        '''
+        if self._faller and not self._game_over:
+            self._remember()
+            landing_row = self._field.landing_row(
+                self._faller.bottom(), self._faller.col())
+            self._faller.drop(landing_row - self._faller.bottom())
+            self._emit_faller(FALLER_DROPPED)
+            self._update()
+            self._publish()
 
     def rotate_faller(self) -> None:
         '''
         Rotates the faller if it exists.
         '''
         if self._faller != None and not self._game_over:
+            self._remember()
             self._faller.rotate()
+            self._grid = None
+            self._emit_faller(FALLER_ROTATED)
+            self._publish()
 
     def move_faller(self, direction: int) -> None:
         '''
         Moves the faller left or right based on a direction.
         '''
         if self._faller and not self._game_over and self._field.empty_rows(self._faller.col()+direction, self._faller.rows()):
+            self._remember()
             self._faller.move(direction)
+            self._grid = None
+            self._emit_faller(FALLER_MOVED)
+            self._publish()
 
     def get_empty_cols(self) -> [int]:
         '''
@@ -367,17 +856,124 @@ class GameState:
         '''
         return self._field.is_landed(self._faller.bottom(), self._faller.col())
 
+    def _remember(self) -> None:
+        '''
+        Starts a new history entry holding the faller, matching jewels and
+        game over state from before a change, and has the field journal the
+        cells the change writes into it. Without a history the cells are
+        only journaled for the subscribers.
+        '''
+        if self._history is None and not self._subscribers:
+            if self._journal is not None:
+                self._detach_journal()
+            return
+        changes = []
+        if self._history is not None:
+            faller = (self._faller.col(), self._faller.rows()[0],
+                      self._faller.colors()[:]) if self._faller else None
+            self._history.append(
+                (changes, faller, list(self._field.matching()), self._game_over))
+        self._journal = changes
+        self._field.set_journal(changes)
+
+    def _detach_journal(self) -> None:
+        '''
+        Stops the field journaling the cells it writes.
+        '''
+        self._journal = None
+        if self._field:
+            self._field.set_journal(None)
+
+    def _emit(self, kind: str, data) -> None:
+        '''
+        Adds an event to be published, if anyone is subscribed.
+        '''
+        if self._subscribers:
+            self._events.append((kind, data))
+
+    def _emit_faller(self, kind: str) -> None:
+        '''
+        Adds a faller event with where the faller is now.
+        '''
+        if self._subscribers:
+            self._events.append((kind, (self._faller.col(), self._faller.rows()[:],
+                                        self._faller.colors()[:], self._check_faller_landed())))
+
+    def _publish(self) -> None:
+        '''
+        Calls every subscriber with the events added since the last call.
+        '''
+        if self._events:
+            events = self._events
+            self._events = []
+            for subscriber in self._subscribers[:]:
+                subscriber(events)
+
+    def _drop_shifts(self, changes: [(int, int, str)], cleared: [(int, int)]) -> [(int, int, int)]:
+        '''
+        Returns the column, old row and new row of every jewel that fell,
+        given the journaled cell changes of a clear and drop and the jewels
+        that were cleared.
+        '''
+        old_colors = {}
+        for row, col, color in changes:
+            old_colors.setdefault((row, col), color)
+        cleared = set(cleared)
+        shifts = []
+        for col in sorted({col for row, col in old_colors}):
+            old_rows = [row for row in range(self.rows() - 1, -1, -1) if (row, col) not in cleared and
+                        old_colors.get((row, col), self._field.get_color(row, col)) != BLANK]
+            new_rows = [row for row in range(self.rows() - 1, -1, -1)
+                        if self._field.get_color(row, col) != BLANK]
+            shifts += [(col, old_row, new_row) for old_row,
+                       new_row in zip(old_rows, new_rows) if old_row != new_row]
+        return shifts
+
     def _update_matching(self) -> None:
         '''
         Updates the matching jewels list. If buffer isn't empty after the 
         update, end the game.
         '''
+        self._grid = None
+        if self._subscribers:
+            cleared = list(self._field.matching())
+            mark = len(self._journal)
+        if self._timer is None:
+            self._field.clear_matching()
+            self._field.drop_field()
+            self._field.locate_matching()
+        else:
+            self._timed_update_matching()
+        if self._subscribers:
+            if cleared:
+                self._emit(CLEARED, cleared)
+            shifts = self._drop_shifts(self._journal[mark:], cleared)
+            if shifts:
+                self._emit(DROPPED, shifts)
+            if not self._field.no_matching():
+                self._emit(MATCHED, list(self._field.matching()))
+
+    def _timed_update_matching(self) -> None:
+        '''
+        Clears, drops and matches the field, recording how long each phase
+        takes with the timer.
+        '''
+        start = time.perf_counter()
         self._field.clear_matching()
+        cleared = time.perf_counter()
         self._field.drop_field()
+        dropped = time.perf_counter()
         self._field.locate_matching()
+        located = time.perf_counter()
+        self._timer.record("update.clear", cleared - start)
+        self._timer.record("update.drop", dropped - cleared)
+        self._timer.record("update.locate", located - dropped)
 
     def _lose_game(self) -> None:
         '''
         If the game is lost, end the game.
         '''
+        if not self._game_over:
+            self._emit(GAME_ENDED, None)
         self._game_over = True
+        self._grid = None
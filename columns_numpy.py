@@ -0,0 +1,268 @@
+# columns_numpy.py
+# A field for the columns game backed by a NumPy array, for very large boards.
+import numpy
+from columns_model import BLANK, DEFAULT_RULES, MATCHING_LENGTH, Faller, MatchRules
+
+BLANK_CODE = 0
+
+
+def drop_cells(cells: numpy.ndarray) -> numpy.ndarray:
+    '''
+    Returns the color codes with every jewel dropped to the bottom of its
+    column. Works on any stack of boards, the rows are the second to last
+    axis.
+    '''
+    order = numpy.argsort(cells != BLANK_CODE, axis=-2, kind="stable")
+    return numpy.take_along_axis(cells, order, axis=-2)
+
+
+def find_matching(cells: numpy.ndarray, buffer_size: int, length: int = MATCHING_LENGTH, diagonals: bool = True) -> numpy.ndarray:
+    '''
+    Returns a boolean mask of the jewels below the buffer that are in a
+    horizontal, vertical or (with diagonals) diagonal run of at least the
+    given length. Works on any stack of boards, the rows are the second to
+    last axis.
+    '''
+    area = cells[..., buffer_size:, :]
+    rows, cols = area.shape[-2:]
+    matching = numpy.zeros(cells.shape, dtype=bool)
+    found = matching[..., buffer_size:, :]
+    directions = ((0, 1), (1, 0), (1, 1), (1, -1)) if diagonals else ((0, 1), (1, 0))
+    for drow, dcol in directions:
+        span_rows = rows - drow*(length - 1)
+        span_cols = cols - abs(dcol)*(length - 1)
+        if span_rows <= 0 or span_cols <= 0:
+            continue
+        first_col = 0 if dcol >= 0 else -dcol*(length - 1)
+
+        def window(step: int) -> numpy.ndarray:
+            row = drow*step
+            col = first_col + dcol*step
+            return area[..., row:row + span_rows, col:col + span_cols]
+
+        starts = window(0) != BLANK_CODE
+        for step in range(1, length):
+            starts &= window(step) == window(0)
+        for step in range(length):
+            row = drow*step
+            col = first_col + dcol*step
+            found[..., row:row + span_rows, col:col + span_cols] |= starts
+    return matching
+
+
+class NumpyField:
+    '''
+    Stores the data of the field as a uint8 array of color codes, which can
+    be used in place of columns_model.Field. Code 0 is a blank cell and the
+    other codes are given out to colors as they are first set. Dropping and
+    matching are skipped when no cell changed since they last ran, so
+    updates that only move the faller don't touch the arrays.
+    '''
+
+    def __init__(self, rows: int, cols: int, buffer_size: int, rules: MatchRules = DEFAULT_RULES):
+        self._rows = rows+buffer_size
+        self._cols = cols
+        self._buffer_size = buffer_size
+        self._rules = rules
+        self._cells = numpy.zeros((self._rows, self._cols), dtype=numpy.uint8)
+        self._matching = numpy.zeros((self._rows, self._cols), dtype=bool)
+        self._any_matching = False
+        self._unsettled = False
+        self._unmatched = False
+        self._color_table = [BLANK]
+        self._color_codes = {BLANK: BLANK_CODE}
+        self._journal = None
+
+    def rows(self) -> int:
+        '''
+        Returns the number of rows in the field.
+        '''
+        return self._rows
+
+    def cols(self) -> int:
+        '''
+        Returns the number of columns in the fields.
+        '''
+        return self._cols
+
+    def buffer_size(self) -> int:
+        '''
+        Returns the size of the buffer.
+        '''
+        return self._buffer_size
+
+    def rules(self) -> MatchRules:
+        '''
+        Returns the match rules.
+        '''
+        return self._rules
+
+    def matching(self) -> [(int, int)]:
+        '''
+        Returns the matching jewel positions.
+        '''
+        return [(int(row), int(col)) for row, col in numpy.argwhere(self._matching)]
+
+    def get_color(self, row: int, col: int) -> str:
+        '''
+        Gets a color from a row and column.
+        '''
+        return self._color_table[self._cells[row, col]]
+
+    def get_row(self, row: int) -> [str]:
+        '''
+        Gets a copy of the colors of a row.
+        '''
+        return [self._color_table[code] for code in self._cells[row].tolist()]
+
+    def clone(self) -> 'NumpyField':
+        '''
+        Returns a copy of the field.
+        '''
+        field = NumpyField.__new__(NumpyField)
+        field._rows = self._rows
+        field._cols = self._cols
+        field._buffer_size = self._buffer_size
+        field._rules = self._rules
+        field._cells = self._cells.copy()
+        field._matching = self._matching.copy()
+        field._any_matching = self._any_matching
+        field._unsettled = self._unsettled
+        field._unmatched = self._unmatched
+        field._color_table = self._color_table[:]
+        field._color_codes = dict(self._color_codes)
+        field._journal = None
+        return field
+
+    def set_color(self, row: int, col: int, val: str) -> None:
+        '''
+        Sets a color for a row and column.
+        '''
+        code = self._code(val)
+        if self._journal is not None and self._cells[row, col] != code:
+            self._journal.append(
+                (row, col, self._color_table[self._cells[row, col]]))
+        self._cells[row, col] = code
+        self._unsettled = self._unmatched = True
+
+    def set_matching(self, matching: [(int, int)]) -> None:
+        '''
+        Replaces the matching jewel positions.
+        '''
+        self._matching[:] = False
+        for row, col in matching:
+            self._matching[row, col] = True
+        self._any_matching = bool(matching)
+
+    def set_journal(self, journal: list) -> None:
+        '''
+        Sets a list that every change to a cell is appended to as the row,
+        column and old color, or None to stop.
+        '''
+        self._journal = journal
+
+    def clear_matching(self) -> None:
+        '''
+        Removes the matching blocks and then empties the mask.
+        '''
+        if not self._any_matching:
+            return
+        if self._journal is not None:
+            self._journal_changes(self._matching)
+        self._cells[self._matching] = BLANK_CODE
+        self._matching[:] = False
+        self._any_matching = False
+        self._unsettled = self._unmatched = True
+
+    def drop_field(self) -> None:
+        '''
+        Instantly drops all pieces in the field.
+        '''
+        if not self._unsettled:
+            return
+        self._unsettled = False
+        cells = drop_cells(self._cells)
+        if self._journal is not None:
+            self._journal_changes(cells != self._cells)
+        self._cells = cells
+
+    def locate_matching(self) -> None:
+        '''
+        Finds all matching jewels in all directions and then adds them to
+        the matching jewels mask.
+        '''
+        if not self._unmatched:
+            return
+        self._unmatched = False
+        self._matching |= find_matching(self._cells, self._rules.first_row(
+            self._buffer_size), self._rules.length(), self._rules.diagonals())
+        self._any_matching = bool(self._matching.any())
+
+    def matching_contains_cell(self, row: int, col: int) -> bool:
+        '''
+        Checks if a cell is in the matching jewels.
+        '''
+        return bool(self._matching[row, col])
+
+    def column_full(self, col: int) -> bool:
+        '''
+        Checks if a column is full.
+        '''
+        return bool(self._cells[self._buffer_size:, col].all())
+
+    def empty_buffer(self) -> bool:
+        '''
+        Checks if the buffer is empty.
+        '''
+        return not self._cells[:self._buffer_size].any()
+
+    def no_matching(self) -> bool:
+        '''
+        Checks if the matching jewels mask is empty.
+        '''
+        return not self._any_matching
+
+    def empty_rows(self, col: int, rows: [int]) -> bool:
+        '''
+        Checks if a column is empty.
+        '''
+        return not col < 0 and not col > self._cols - 1 and not self._cells[rows, col].any()
+
+    def is_landed(self, row: int, col: int) -> bool:
+        '''
+        Checks if a cell has landed (on top of a jewel or the floor).
+        '''
+        return row == self._rows - 1 or self._cells[row + 1, col] != BLANK_CODE
+
+    def landing_row(self, row: int, col: int) -> int:
+        '''
+        Returns the row a jewel falling from a row in a column lands on.
+        '''
+        below = numpy.flatnonzero(self._cells[row + 1:, col])
+        return row + int(below[0]) if len(below) else self._rows - 1
+
+    def freeze_faller(self, faller: Faller) -> None:
+        '''
+        Freezes a faller into place.
+        '''
+        for row in faller.rows():
+            self.set_color(row, faller.col(), faller.get_color(row))
+
+    def _journal_changes(self, changed: numpy.ndarray) -> None:
+        '''
+        Journals the old color of every cell in a boolean mask.
+        '''
+        for row, col in numpy.argwhere(changed).tolist():
+            self._journal.append(
+                (row, col, self._color_table[self._cells[row, col]]))
+
+    def _code(self, color: str) -> int:
+        '''
+        Returns the code of a color, adding it to the color table if needed.
+        '''
+        if color not in self._color_codes:
+            if len(self._color_table) > numpy.iinfo(numpy.uint8).max:
+                raise ValueError("too many colors for a uint8 field")
+            self._color_codes[color] = len(self._color_table)
+            self._color_table.append(color)
+        return self._color_codes[color]
@@ -0,0 +1,190 @@
+# columns_replay.py
+# Records games as a seed and a stream of inputs, and plays them back
+# without a display to check their scores.
+import argparse
+import concurrent.futures
+import struct
+import columns_session
+
+REPLAY_MAGIC = b"CREP"
+REPLAY_VERSION = 1
+REPLAY_HEADER = struct.Struct("<4sBHHQB")
+END = 0
+INPUT_BITS = 3
+
+
+def _encode_varint(value: int) -> bytes:
+    '''
+    Encodes a non-negative integer in seven bit groups, low groups first.
+    '''
+    data = bytearray()
+    while value >= 0x80:
+        data.append((value & 0x7F) | 0x80)
+        value >>= 7
+    data.append(value)
+    return bytes(data)
+
+
+def _decode_varint(data: bytes, offset: int) -> (int, int):
+    '''
+    Decodes an integer made by _encode_varint, returning it and the offset
+    after it.
+    '''
+    value = 0
+    shift = 0
+    while True:
+        if offset >= len(data):
+            raise EOFError("replay ends in the middle of a number")
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7F) << shift
+        shift += 7
+        if byte < 0x80:
+            return value, offset
+
+
+class ReplayWriter:
+    '''
+    Streams a game to a file as it is played. The file starts with the
+    board size, seed and colors. Each input is stored as one number holding
+    the frames since the last input and the input itself, which usually
+    fits in one or two bytes. finish() writes an end marker with the final
+    frame and the score.
+    '''
+
+    def __init__(self, path: str, rows: int, cols: int, colors: [str], seed: int):
+        self._file = open(path, "wb")
+        self._frame = 0
+        self._file.write(REPLAY_HEADER.pack(
+            REPLAY_MAGIC, REPLAY_VERSION, rows, cols, seed, len(colors)))
+        for color in colors:
+            encoded = color.encode()
+            self._file.write(bytes([len(encoded)]) + encoded)
+
+    def record(self, frame: int, action: int) -> None:
+        '''
+        Records an input given before the frame with the given number.
+        '''
+        self._file.write(_encode_varint(
+            ((frame - self._frame) << INPUT_BITS) | action))
+        self._frame = frame
+
+    def finish(self, frame: int, score: int) -> None:
+        '''
+        Records the end of the game and closes the file.
+        '''
+        self.record(frame, END)
+        self._file.write(_encode_varint(score))
+        self._file.close()
+
+
+class Replay:
+    '''
+    Stores a recorded game read from a file.
+    '''
+
+    def __init__(self, path: str):
+        with open(path, "rb") as file:
+            data = file.read()
+        magic, version, self._rows, self._cols, self._seed, colors = \
+            REPLAY_HEADER.unpack_from(data)
+        if magic != REPLAY_MAGIC or version != REPLAY_VERSION:
+            raise ValueError(f"{path} is not a replay")
+        offset = REPLAY_HEADER.size
+        self._colors = []
+        for color in range(colors):
+            length = data[offset]
+            self._colors.append(data[offset + 1:offset + 1 + length].decode())
+            offset += 1 + length
+
+        self._inputs = []
+        self._end_frame = None
+        self._score = None
+        frame = 0
+        while offset < len(data):
+            value, offset = _decode_varint(data, offset)
+            frame += value >> INPUT_BITS
+            action = value & ((1 << INPUT_BITS) - 1)
+            if action == END:
+                self._end_frame = frame
+                self._score, offset = _decode_varint(data, offset)
+                break
+            self._inputs.append((frame, action))
+
+    def seed(self) -> int:
+        '''
+        Returns the seed of the game.
+        '''
+        return self._seed
+
+    def inputs(self) -> [(int, int)]:
+        '''
+        Returns the (frame, input) pairs of the game.
+        '''
+        return self._inputs
+
+    def colors(self) -> [str]:
+        '''
+        Returns the colors of the game.
+        '''
+        return self._colors
+
+    def score(self) -> int:
+        '''
+        Returns the recorded score, or None if the game was never finished.
+        '''
+        return self._score
+
+    def end_frame(self) -> int:
+        '''
+        Returns the frame the game ended on, or None if it was never
+        finished.
+        '''
+        return self._end_frame
+
+    def new_session(self) -> columns_session.GameSession:
+        '''
+        Returns a session at the start of the game.
+        '''
+        return columns_session.GameSession(
+            self._rows, self._cols, self._colors, self._seed)
+
+    def play(self) -> columns_session.GameSession:
+        '''
+        Plays the game back as fast as possible and returns the session
+        at the recorded end.
+        '''
+        session = self.new_session()
+        for frame, action in self._inputs:
+            session.fast_forward(frame - session.frames())
+            session.handle_input(action)
+        if self._end_frame is not None:
+            session.fast_forward(self._end_frame - session.frames())
+        return session
+
+
+def verify_replay(path: str) -> (bool, int, int):
+    '''
+    Plays a replay back and checks that it reaches the recorded score.
+    Returns whether it did, the recorded score and the replayed score.
+    '''
+    replay = Replay(path)
+    score = replay.play().score()
+    return replay.score() == score, replay.score(), score
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Checks that replays reach their recorded scores.")
+    parser.add_argument("paths", nargs="+")
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+
+    failed = 0
+    with concurrent.futures.ProcessPoolExecutor(args.workers) as executor:
+        for path, (matched, recorded, replayed) in zip(args.paths, executor.map(verify_replay, args.paths)):
+            if not matched:
+                failed += 1
+                print(f"{path}: recorded {recorded}, replayed {replayed}")
+    print(f"{len(args.paths) - failed} of {len(args.paths)} replays verified")
+    raise SystemExit(1 if failed else 0)
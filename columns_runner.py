@@ -0,0 +1,115 @@
+# columns_runner.py
+# Plays many headless columns games across a process pool and reports
+# their stats.
+import argparse
+import concurrent.futures
+import functools
+import hashlib
+import json
+import os
+import random
+import columns_ai
+import columns_model
+import columns_session
+
+ROWS = 13
+COLUMNS = 6
+MAX_TICKS = 100000
+STATS = ("score", "pieces", "matches", "ticks")
+
+
+def derive_seed(seed: int, game: int) -> int:
+    '''
+    Derives the seed of one game from the seed of the whole run, so that
+    every game plays the same no matter which worker runs it.
+    '''
+    digest = hashlib.sha256(f"{seed}:{game}".encode()).digest()
+    return int.from_bytes(digest[:8], "little")
+
+
+def random_policy(session: columns_session.GameSession, rng: random.Random) -> int:
+    '''
+    Picks a random input (or None for no input) for the next update.
+    '''
+    return rng.choice([None, columns_session.MOVE_LEFT, columns_session.MOVE_RIGHT,
+                       columns_session.ROTATE, columns_session.DROP])
+
+
+def play_game(seed: int, rows: int = ROWS, cols: int = COLUMNS, policy=random_policy, max_ticks: int = MAX_TICKS, instant_cascades: bool = False, rules: columns_model.MatchRules = columns_model.DEFAULT_RULES) -> dict:
+    '''
+    Plays a game to the end, giving the policy one input before every
+    update, and returns its stats.
+    '''
+    session = columns_session.GameSession(
+        rows, cols, seed=seed, instant_cascades=instant_cascades, rules=rules)
+    rng = random.Random(seed)
+    while not session.game_over() and session.ticks() < max_ticks:
+        action = policy(session, rng)
+        if action is not None:
+            session.handle_input(action)
+        session.update_state()
+    return {"seed": seed, "score": session.score(), "pieces": session.pieces(),
+            "matches": session.matches(), "ticks": session.ticks()}
+
+
+def summarize(results: [dict]) -> dict:
+    '''
+    Combines the stats of many games into one report.
+    '''
+    report = {"games": len(results)}
+    for stat in STATS:
+        values = [result[stat] for result in results]
+        report[stat] = {"total": sum(values), "mean": sum(values)/max(1, len(values)),
+                        "min": min(values, default=0), "max": max(values, default=0)}
+    report["results"] = results
+    return report
+
+
+def run_games(games: int, seed: int = 0, workers: int = None, rows: int = ROWS, cols: int = COLUMNS, policy=random_policy, max_ticks: int = MAX_TICKS, instant_cascades: bool = False, rules: columns_model.MatchRules = columns_model.DEFAULT_RULES) -> dict:
+    '''
+    Plays a number of games across a process pool and returns the
+    combined report. The policy has to be picklable.
+    '''
+    seeds = [derive_seed(seed, game) for game in range(games)]
+    play = functools.partial(play_game, rows=rows, cols=cols,
+                             policy=policy, max_ticks=max_ticks,
+                             instant_cascades=instant_cascades, rules=rules)
+    workers = workers or os.cpu_count() or 1
+    chunksize = max(1, games // (4*workers))
+    with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+        results = list(executor.map(play, seeds, chunksize=chunksize))
+    return summarize(results)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Plays many headless columns games.")
+    parser.add_argument("--games", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--rows", type=int, default=ROWS)
+    parser.add_argument("--cols", type=int, default=COLUMNS)
+    parser.add_argument("--max-ticks", type=int, default=MAX_TICKS)
+    parser.add_argument("--planner", action="store_true",
+                        help="play with the search planner instead of random inputs")
+    parser.add_argument("--instant-cascades", action="store_true",
+                        help="resolve chain reactions in the update that starts them")
+    parser.add_argument("--match-length", type=int, default=columns_model.MATCHING_LENGTH,
+                        help="shortest run of jewels that matches")
+    parser.add_argument("--no-diagonals", action="store_true",
+                        help="only match horizontal and vertical runs")
+    parser.add_argument("--match-buffer", action="store_true",
+                        help="let jewels in the buffer rows match")
+    parser.add_argument("--output", default=None,
+                        help="file to write the full report to")
+    args = parser.parse_args()
+
+    policy = columns_ai.PlannerPolicy() if args.planner else random_policy
+    report = run_games(args.games, args.seed, args.workers,
+                       args.rows, args.cols, policy, args.max_ticks,
+                       args.instant_cascades,
+                       columns_model.MatchRules(args.match_length, not args.no_diagonals, args.match_buffer))
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+    print(json.dumps({stat: report[stat] for stat in ("games",) + STATS}, indent=2))
@@ -0,0 +1,318 @@
+# columns_server.py
+# Hosts many columns games in one asyncio event loop over TCP or Unix
+# sockets, with a reference client.
+import argparse
+import asyncio
+import random
+import struct
+import columns_model
+import columns_runner
+import columns_session
+
+NEW_GAME = 6
+INPUTS = (columns_session.MOVE_LEFT, columns_session.MOVE_RIGHT, columns_session.ROTATE,
+          columns_session.DROP, columns_session.HARD_DROP, NEW_GAME)
+
+HELLO = 1
+BOARD = 2
+MESSAGE_HEADER = struct.Struct("<BI")
+HELLO_HEADER = struct.Struct("<HHBB")
+BOARD_HEADER = struct.Struct("<IBBH")
+CELL = struct.Struct("<HBB")
+GAME_OVER_FLAG = 1
+
+INPUT_INTERVAL = 0.05
+BACKLOG = 1024
+
+
+def _pack_message(kind: int, payload: bytes) -> bytes:
+    '''
+    Frames a message with its kind and length.
+    '''
+    return MESSAGE_HEADER.pack(kind, len(payload)) + payload
+
+
+async def _read_message(reader: asyncio.StreamReader) -> (int, bytes):
+    '''
+    Reads one framed message.
+    '''
+    kind, length = MESSAGE_HEADER.unpack(await reader.readexactly(MESSAGE_HEADER.size))
+    return kind, await reader.readexactly(length)
+
+
+class ServerSession:
+    '''
+    Plays one game session for a connection. Gravity runs on the session's
+    own schedule, inputs are applied as soon as they arrive, and after
+    every change the cells that differ from what the client last saw are
+    sent to it.
+
+    Input bytes are columns_session inputs, or NEW_GAME. Board messages
+    hold the score, a game over flag, the next faller and the changed cells
+    as (row*cols + col, type, color code); color code 0 is blank and the
+    others index the color list sent in the hello message.
+    '''
+
+    def __init__(self, session: columns_session.GameSession, colors: [str], reader: asyncio.StreamReader, writer: asyncio.StreamWriter, speed: float):
+        self._session = session
+        self._codes = {color: code for code,
+                       color in enumerate([columns_model.BLANK] + list(colors))}
+        self._reader = reader
+        self._writer = writer
+        self._speed = speed
+        self._sent_grid = None
+        self._changed = asyncio.Event()
+
+    async def run(self) -> None:
+        '''
+        Plays until the client disconnects.
+        '''
+        state = self._session.state()
+        colors = [color for color in self._codes if color != columns_model.BLANK]
+        hello = bytearray(HELLO_HEADER.pack(
+            state.rows(), state.cols(), state.buffer_size(), len(colors)))
+        for color in colors:
+            encoded = color.encode()
+            hello += bytes([len(encoded)]) + encoded
+        self._writer.write(_pack_message(HELLO, bytes(hello)))
+        await self._send_board()
+
+        gravity = asyncio.create_task(self._gravity())
+        try:
+            while True:
+                data = await self._reader.read(256)
+                if not data:
+                    break
+                for action in data:
+                    self._apply(action)
+                await self._send_board()
+        except ConnectionError:
+            pass
+        finally:
+            gravity.cancel()
+            self._writer.close()
+
+    def _apply(self, action: int) -> None:
+        '''
+        Applies an input from the client.
+        '''
+        if action == NEW_GAME:
+            self._session.new_game()
+            self._changed.set()
+        elif action in INPUTS:
+            self._session.handle_input(action)
+
+    async def _gravity(self) -> None:
+        '''
+        Updates the session on its own gravity curve while the game is on,
+        and waits for a new game when it is over.
+        '''
+        try:
+            while True:
+                if self._session.game_over():
+                    self._changed.clear()
+                    await self._changed.wait()
+                await asyncio.sleep(self._session.gravity_delay()/(columns_session.FRAME_RATE*self._speed))
+                self._session.update_state()
+                await self._send_board()
+        except ConnectionError:
+            pass
+
+    async def _send_board(self) -> None:
+        '''
+        Sends the cells that changed since the last board message.
+        '''
+        grid = self._session.state().render_grid()
+        types, colors = grid
+        cols = len(types[0])
+        cells = bytearray()
+        count = 0
+        for row in range(len(types)):
+            if self._sent_grid and self._sent_grid[0][row] == types[row] and self._sent_grid[1][row] == colors[row]:
+                continue
+            for col in range(cols):
+                if not self._sent_grid or self._sent_grid[0][row][col] != types[row][col] or self._sent_grid[1][row][col] != colors[row][col]:
+                    cells += CELL.pack(row*cols + col,
+                                       types[row][col], self._codes[colors[row][col]])
+                    count += 1
+        self._sent_grid = grid
+        next_colors = bytes(self._codes[color]
+                            for color in self._session.next_colors())
+        flags = GAME_OVER_FLAG if self._session.game_over() else 0
+        payload = BOARD_HEADER.pack(self._session.score(), flags, len(next_colors), count) + \
+            next_colors + bytes(cells)
+        self._writer.write(_pack_message(BOARD, payload))
+        await self._writer.drain()
+
+
+class GameServer:
+    '''
+    Accepts connections and gives each one its own game session, all in
+    one event loop. Sessions are seeded from the server seed and the order
+    they connected in. Speed scales how fast gravity runs.
+    '''
+
+    def __init__(self, rows: int = columns_runner.ROWS, cols: int = columns_runner.COLUMNS, colors: [str] = columns_model.COLORS, seed: int = 0, speed: float = 1.0):
+        self._rows = rows
+        self._cols = cols
+        self._colors = list(colors)
+        self._seed = seed
+        self._speed = speed
+        self._connections = 0
+        self._active = 0
+
+    def active(self) -> int:
+        '''
+        Returns the number of sessions being played.
+        '''
+        return self._active
+
+    async def start(self, host: str = None, port: int = None, path: str = None) -> asyncio.AbstractServer:
+        '''
+        Starts listening on a Unix socket if a path is given, or on TCP.
+        '''
+        if path:
+            return await asyncio.start_unix_server(self._serve, path, backlog=BACKLOG)
+        return await asyncio.start_server(self._serve, host, port, backlog=BACKLOG)
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        '''
+        Plays a session for a new connection.
+        '''
+        seed = columns_runner.derive_seed(self._seed, self._connections)
+        self._connections += 1
+        session = columns_session.GameSession(
+            self._rows, self._cols, self._colors, seed)
+        self._active += 1
+        try:
+            await ServerSession(session, self._colors, reader, writer, self._speed).run()
+        finally:
+            self._active -= 1
+
+
+class GameClient:
+    '''
+    Keeps a copy of a server session's board up to date from its board
+    messages and sends inputs to it.
+    '''
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._reader = reader
+        self._writer = writer
+        self._types = None
+        self._colors = None
+        self._palette = [columns_model.BLANK]
+        self._score = 0
+        self._game_over = False
+        self._next_colors = []
+
+    async def read_hello(self) -> None:
+        '''
+        Reads the board size and colors sent when connecting.
+        '''
+        kind, payload = await _read_message(self._reader)
+        rows, cols, buffer_size, colors = HELLO_HEADER.unpack_from(payload)
+        offset = HELLO_HEADER.size
+        for color in range(colors):
+            length = payload[offset]
+            self._palette.append(
+                payload[offset + 1:offset + 1 + length].decode())
+            offset += 1 + length
+        self._types = [[columns_model.NONE]*cols for row in range(rows)]
+        self._colors = [[columns_model.BLANK]*cols for row in range(rows)]
+
+    async def read_board(self) -> None:
+        '''
+        Reads one board message and applies it.
+        '''
+        kind, payload = await _read_message(self._reader)
+        self._score, flags, next_count, count = BOARD_HEADER.unpack_from(
+            payload)
+        self._game_over = bool(flags & GAME_OVER_FLAG)
+        offset = BOARD_HEADER.size
+        self._next_colors = [self._palette[code]
+                             for code in payload[offset:offset + next_count]]
+        offset += next_count
+        cols = len(self._types[0])
+        for cell in range(count):
+            index, cell_type, code = CELL.unpack_from(payload, offset)
+            offset += CELL.size
+            self._types[index // cols][index % cols] = cell_type
+            self._colors[index // cols][index % cols] = self._palette[code]
+
+    def send(self, action: int) -> None:
+        '''
+        Sends an input to the server.
+        '''
+        self._writer.write(bytes([action]))
+
+    def types(self) -> [[int]]:
+        return self._types
+
+    def colors(self) -> [[str]]:
+        return self._colors
+
+    def score(self) -> int:
+        return self._score
+
+    def game_over(self) -> bool:
+        return self._game_over
+
+    def close(self) -> None:
+        self._writer.close()
+
+
+async def play_client(host: str = None, port: int = None, path: str = None, seed: int = None) -> int:
+    '''
+    Connects to a server, plays one game with random inputs and returns
+    the final score.
+    '''
+    if path:
+        reader, writer = await asyncio.open_unix_connection(path)
+    else:
+        reader, writer = await asyncio.open_connection(host, port)
+    client = GameClient(reader, writer)
+    await client.read_hello()
+    rng = random.Random(seed)
+
+    async def send_inputs() -> None:
+        while True:
+            await asyncio.sleep(INPUT_INTERVAL)
+            client.send(rng.choice(INPUTS[:-1]))
+
+    inputs = asyncio.create_task(send_inputs())
+    try:
+        while not client.game_over():
+            await client.read_board()
+    finally:
+        inputs.cancel()
+        client.close()
+    return client.score()
+
+
+async def _main(args: argparse.Namespace) -> None:
+    if args.command == "serve":
+        server = await GameServer(seed=args.seed, speed=args.speed).start(args.host, args.port, args.unix)
+        async with server:
+            await server.serve_forever()
+    else:
+        scores = await asyncio.gather(*[play_client(args.host, args.port, args.unix, columns_runner.derive_seed(args.seed, client))
+                                        for client in range(args.clients)])
+        print(f"{len(scores)} games, mean score {sum(scores)/len(scores):.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Hosts or plays columns games over a socket.")
+    parser.add_argument("command", choices=["serve", "play"])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=7373)
+    parser.add_argument("--unix", metavar="PATH", default=None,
+                        help="use a Unix socket instead of TCP")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="how many times faster than normal gravity runs")
+    parser.add_argument("--clients", type=int, default=1,
+                        help="number of games to play at once")
+    args = parser.parse_args()
+    asyncio.run(_main(args))
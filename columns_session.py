@@ -0,0 +1,205 @@
+# columns_session.py
+# Plays a columns game without a display: faller generation, gravity and
+# scoring.
+import math
+import random
+import columns_model
+
+FRAME_RATE = 30
+DEFAULT_SPEED = 15
+ACCELERATION_SPEED = 0.2
+
+MOVE_LEFT = 1
+MOVE_RIGHT = 2
+ROTATE = 3
+DROP = 4
+HARD_DROP = 5
+
+
+class GameSession:
+    '''
+    Runs one game at a time on a game state. Fallers are created in a
+    random empty column with colors queued up one faller ahead, and all
+    randomness comes from the session's own seeded generator. With
+    instant_cascades, chain reactions are resolved and scored in the same
+    update that starts them instead of one link per update. A timer and
+    the match rules are passed on to every game state the session creates.
+    '''
+
+    def __init__(self, rows: int, cols: int, colors: [str] = columns_model.COLORS, seed: int = None, field_class: type = columns_model.Field, instant_cascades: bool = False, timer=None, rules: columns_model.MatchRules = columns_model.DEFAULT_RULES):
+        self._rows = rows
+        self._rules = rules
+        self._timer = timer
+        self._instant_cascades = instant_cascades
+        self._cols = cols
+        self._colors = list(colors)
+        self._field_class = field_class
+        self._random = random.Random(seed)
+        self.new_game()
+
+    def new_game(self, seed: int = None) -> None:
+        '''
+        Starts a new game, reseeding the generator if a seed is given.
+        '''
+        if seed is not None:
+            self._random.seed(seed)
+        self._state = columns_model.GameState(self._field_class, self._rules)
+        self._state.initialize_field(self._rows, self._cols)
+        self._state.set_timer(self._timer)
+        self._lost = False
+        self._frame = 0
+        self._frames = 0
+        self._score = 0
+        self._pieces = 0
+        self._matches = 0
+        self._ticks = 0
+        self._queue_next_faller()
+
+    def state(self) -> columns_model.GameState:
+        '''
+        Returns the game state.
+        '''
+        return self._state
+
+    def score(self) -> int:
+        '''
+        Returns the number of jewels matched this game.
+        '''
+        return self._score
+
+    def pieces(self) -> int:
+        '''
+        Returns the number of fallers frozen into the field this game.
+        '''
+        return self._pieces
+
+    def matches(self) -> int:
+        '''
+        Returns the number of updates that found matching jewels this game.
+        '''
+        return self._matches
+
+    def frames(self) -> int:
+        '''
+        Returns the number of frames advanced this game.
+        '''
+        return self._frames
+
+    def ticks(self) -> int:
+        '''
+        Returns the number of times the state was updated this game.
+        '''
+        return self._ticks
+
+    def next_colors(self) -> [str]:
+        '''
+        Returns the colors of the next faller.
+        '''
+        return self._next_colors
+
+    def game_over(self) -> bool:
+        '''
+        Checks if the game is over, either by the state or by having no
+        column to create a faller in.
+        '''
+        return self._lost or self._state.game_over()
+
+    def handle_input(self, action: int) -> None:
+        '''
+        Applies a player input to the game.
+        '''
+        if self.game_over():
+            return
+        if action == MOVE_LEFT:
+            self._state.move_faller(columns_model.LEFT)
+        elif action == MOVE_RIGHT:
+            self._state.move_faller(columns_model.RIGHT)
+        elif action == ROTATE:
+            self._state.rotate_faller()
+        elif action == DROP:
+            self.update_state()
+        elif action == HARD_DROP and not self._state.no_faller():
+            self._state.hard_drop()
+            self._after_update(True)
+
+    def gravity_delay(self) -> float:
+        '''
+        Returns the number of frames between gravity updates, which goes
+        down as the score goes up. There are FRAME_RATE frames a second.
+        '''
+        return max(2, DEFAULT_SPEED/math.log(self._score*ACCELERATION_SPEED + 3))
+
+    def advance_frame(self) -> None:
+        '''
+        Counts a frame and updates the state once enough frames have
+        passed.
+        '''
+        self._frames += 1
+        self._frame += 1
+        if self._frame >= self.gravity_delay():
+            self.update_state()
+            self._frame = 0
+
+    def fast_forward(self, frames: int, policy=None) -> int:
+        '''
+        Advances up to the given number of frames as fast as possible,
+        stopping early if the game ends. The policy is called with the
+        session before every frame and returns an input or None. Returns
+        the number of frames advanced.
+        '''
+        for frame in range(frames):
+            if self.game_over():
+                return frame
+            if policy is not None:
+                action = policy(self)
+                if action is not None:
+                    self.handle_input(action)
+            self.advance_frame()
+        return frames
+
+    def update_state(self) -> None:
+        '''
+        Updates the state and score, creates a faller if there is none.
+        '''
+        if self.game_over():
+            return
+        had_faller = not self._state.no_faller()
+        self._state.update()
+        self._after_update(had_faller)
+
+    def _after_update(self, had_faller: bool) -> None:
+        '''
+        Counts an update of the state and scores it, creates a faller if
+        there is none.
+        '''
+        self._ticks += 1
+        if had_faller and self._state.no_faller():
+            self._pieces += 1
+        if self._instant_cascades:
+            chain = self._state.resolve_cascade()
+        else:
+            chain = [self._state.matching()] if self._state.matching() else []
+        for link in chain:
+            self._score += len(link)
+            self._matches += 1
+        if self._state.no_faller() and len(self._state.matching()) == 0:
+            self._create_faller()
+
+    def _create_faller(self) -> None:
+        '''
+        Creates a faller if there is a column empty, or ends the game.
+        '''
+        empty_cols = self._state.get_empty_cols()
+        if len(empty_cols) == 0:
+            self._lost = True
+        else:
+            self._state.initialize_faller(
+                self._random.choice(empty_cols), self._next_colors)
+            self._queue_next_faller()
+
+    def _queue_next_faller(self) -> None:
+        '''
+        Sets up the colors for the next faller.
+        '''
+        self._next_colors = [self._random.choice(
+            self._colors) for color in range(columns_model.FALLER_LENGTH)]
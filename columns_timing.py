@@ -0,0 +1,81 @@
+# columns_timing.py
+# Collects how long each phase of the game takes.
+import collections
+import json
+import threading
+
+WINDOW_SIZE = 600
+
+
+def _pick(samples: [float], fraction: float) -> float:
+    '''
+    Returns the sample that the given fraction of the sorted samples is at
+    or below, or 0 if there are none.
+    '''
+    if not samples:
+        return 0.0
+    return samples[min(len(samples) - 1, int(fraction*len(samples)))]
+
+
+class PhaseTimer:
+    '''
+    Keeps the durations of the last WINDOW_SIZE runs of each named phase so
+    that percentiles can be read from a rolling window. Phases can be
+    recorded and read from different threads.
+    '''
+
+    def __init__(self, window_size: int = WINDOW_SIZE):
+        self._window_size = window_size
+        self._samples = {}
+        self._counts = collections.Counter()
+        self._lock = threading.Lock()
+
+    def record(self, phase: str, seconds: float) -> None:
+        '''
+        Adds a duration to the window of a phase.
+        '''
+        with self._lock:
+            if phase not in self._samples:
+                self._samples[phase] = collections.deque(
+                    maxlen=self._window_size)
+            self._samples[phase].append(seconds)
+            self._counts[phase] += 1
+
+    def phases(self) -> [str]:
+        '''
+        Returns the names of the phases in the order they were first seen.
+        '''
+        with self._lock:
+            return list(self._samples)
+
+    def percentile(self, phase: str, fraction: float) -> float:
+        '''
+        Returns the duration that the given fraction of the phase's window
+        is at or below, or 0 if it has no samples.
+        '''
+        with self._lock:
+            samples = sorted(self._samples.get(phase, ()))
+        return _pick(samples, fraction)
+
+    def summary(self) -> {str: {str: float}}:
+        '''
+        Returns the count and the p50, p90, p99 and longest durations in
+        milliseconds of every phase.
+        '''
+        with self._lock:
+            windows = {phase: sorted(samples)
+                       for phase, samples in self._samples.items()}
+            counts = dict(self._counts)
+        return {phase: {"count": counts[phase],
+                        "p50_ms": _pick(samples, 0.5)*1000,
+                        "p90_ms": _pick(samples, 0.9)*1000,
+                        "p99_ms": _pick(samples, 0.99)*1000,
+                        "max_ms": samples[-1]*1000}
+                for phase, samples in windows.items()}
+
+    def dump(self, path: str) -> None:
+        '''
+        Writes the summary to a JSON file.
+        '''
+        with open(path, "w") as file:
+            json.dump(self.summary(), file, indent=2)
@@ -1,19 +1,43 @@
 # game.py
 # The pygame implementation of the Columns game.
-import random
+import argparse
+import functools
 import math
+import os
+import queue
+import random
+import threading
+import time
 import pygame
+import columns_ai
 import columns_model
+import columns_replay
+import columns_runner
+import columns_session
+import columns_timing
 
 ROWS = 13
 COLUMNS = 6
 DEFAULT_SIZE = (720, 720)
 MARGIN_SIZE = 0.05
-DEFAULT_SPEED = 15
-ACCELERATION_SPEED = 0.2
+FRAME_RATE = columns_session.FRAME_RATE
+MAX_CATCH_UP_FRAMES = 10
+SNAPSHOT_WAIT = 0.005
 
 FONT_SIZE = 0.025
+OVERLAY_FONT_SIZE = 0.014
+OVERLAY_TOP = MARGIN_SIZE*17
+OVERLAY_LINE_SIZE = 0.015
+OVERLAY_REFRESH = 15
 FONT_COLOR = pygame.Color(0, 0, 0)
+TEXT_CACHE_SIZE = 256
+
+WALL_GAMES = 64
+WALL_MARGIN = 0.01
+WALL_GAP = 0.06
+WALL_LABEL_ROWS = 1.5
+WALL_INPUT_FRAMES = 10
+WALL_RESTART_FRAMES = FRAME_RATE*2
 
 BORDER_SIZE = 0.0025
 BORDER_COLOR = pygame.Color(0, 0, 0)
@@ -29,19 +53,152 @@ COLORS = {"A": pygame.Color(255, 0, 0),
           "G": pygame.Color(238, 130, 238)}
 
 
-class ColumnsGame:
+class Snapshot:
     '''
-    Controls the view and input of the game.
+    Stores what the view draws of a game at one moment: the render grid,
+    the scores, the next faller colors and whether a game is started and
+    over. The state builds new render grid lists whenever it changes
+    instead of changing the old ones, so the grid can be kept without a
+    copy. Snapshots are never changed once made, so they can be handed
+    from one thread to another.
+    '''
+
+    def __init__(self, grid: ([[int]], [[str]]), score: int, high_score: int, next_colors: [str], started: bool, game_over: bool):
+        self._grid = grid
+        self._score = score
+        self._high_score = high_score
+        self._next_colors = next_colors
+        self._started = started
+        self._game_over = game_over
+
+    def grid(self) -> ([[int]], [[str]]):
+        '''
+        Returns the type and color of every cell, as render_grid would.
+        '''
+        return self._grid
+
+    def score(self) -> int:
+        '''
+        Returns the score of the game.
+        '''
+        return self._score
+
+    def high_score(self) -> int:
+        '''
+        Returns the highest score of the games played so far.
+        '''
+        return self._high_score
+
+    def next_colors(self) -> [str]:
+        '''
+        Returns the colors of the next faller.
+        '''
+        return self._next_colors
+
+    def started(self) -> bool:
+        '''
+        Checks if a game is being played.
+        '''
+        return self._started
+
+    def game_over(self) -> bool:
+        '''
+        Checks if the game is over.
+        '''
+        return self._game_over
+
+
+class SnapshotBuffer:
+    '''
+    Hands snapshots from the thread that makes them to the thread that
+    draws them. A new snapshot is put in the back slot and then swapped to
+    the front under a lock, so taking one never waits for more than the
+    swap (or for a snapshot that shows given commands, if asked to) and
+    snapshots that are never taken are simply replaced. The times of the
+    inputs shown by each snapshot are kept until taken, even if the
+    snapshot itself was skipped.
     '''
 
     def __init__(self):
+        self._slots = [None, None]
+        self._front = 0
+        self._input_times = []
+        self._commands = 0
+        self._waiting = False
+        self._lock = threading.Lock()
+        self._published = threading.Condition(self._lock)
+
+    def publish(self, snapshot: Snapshot, input_times: [float], commands: int = 0) -> None:
+        '''
+        Makes a snapshot the latest one, along with the times of the inputs
+        applied since the last snapshot and the number of commands handled
+        so far.
+        '''
+        back = 1 - self._front
+        self._slots[back] = snapshot
+        with self._lock:
+            self._front = back
+            self._input_times += input_times
+            self._commands = commands
+            if self._waiting:
+                self._published.notify()
+
+    def take(self, commands: int = 0, timeout: float = 0) -> (Snapshot, [float]):
+        '''
+        Returns the latest snapshot and the times of the inputs published
+        since the last call, first waiting up to the timeout for a snapshot
+        that shows the given number of commands.
+        '''
+        with self._lock:
+            if self._commands < commands:
+                self._waiting = True
+                self._published.wait_for(
+                    lambda: self._commands >= commands, timeout)
+                self._waiting = False
+            input_times = self._input_times
+            self._input_times = []
+            return self._slots[self._front], input_times
+
+
+class ColumnsGame:
+    '''
+    Controls the view and input of the game. The view draws from snapshots
+    of the game. When threaded, the session is advanced on a simulation
+    thread that publishes the snapshots, and the main thread only handles
+    events and draws the latest one, so long updates don't hold up drawing
+    or input.
+    '''
+
+    def __init__(self, dirty_rects: bool = False, record_dir: str = None, perf_path: str = None, low_latency: bool = False, threaded: bool = False):
         self._started = False
         self._running = True
+        self._timer = columns_timing.PhaseTimer()
+        self._perf_path = perf_path
+        self._show_overlay = False
+        self._overlay_lines = []
+        self._frames_drawn = 0
+        self._record_dir = record_dir
+        self._recorder = None
+        self._lag = 0.0
+        self._low_latency = low_latency
+        self._last_advance = 0.0
+        self._input_times = []
+        self._threaded = threaded
+        self._simulation = None
+        self._commands = queue.SimpleQueue()
+        self._commands_sent = 0
+        self._commands_handled = 0
+        self._snapshots = SnapshotBuffer()
+        self._snapshot = None
+        self._dirty_rects = dirty_rects
+        self._full_redraw = True
+        self._drawn_grid = None
+        self._drawn_menu = {}
+        self._cell_rects = []
+        self._cell_sprites = {}
+        self._text_surfaces = {}
 
-        self._frame = 0
-        self._score = 0
         self._high_score = 0
-        self._next_colors = []
 
     def run(self) -> None:
         '''
@@ -64,146 +221,393 @@ class ColumnsGame:
         pygame.display.set_caption("COLUMNS!")
         self._set_surface(DEFAULT_SIZE)
         self._clock = pygame.time.Clock()
+        self._last_advance = time.perf_counter()
+        self._publish_snapshot()
+        if self._threaded:
+            self._simulation = threading.Thread(
+                target=self._simulate, daemon=True)
+            self._simulation.start()
 
     def _initialize_state(self) -> None:
         '''
-        Creates the game state and initializes the field.
+        Creates the game session and its state.
         '''
-        self._state = columns_model.GameState()
-        self._state.initialize_field(ROWS, COLUMNS)
+        self._session = columns_session.GameSession(
+            ROWS, COLUMNS, list(COLORS.keys()), timer=self._timer)
+        self._state = self._session.state()
 
     def _set_surface(self, size: (int, int)) -> None:
         '''
-        Resets the screen surface and font size.
+        Resets the screen surface and font size, along with the cell
+        geometry and the cached sprites and text that depend on them.
         '''
         pygame.display.set_mode(size, pygame.RESIZABLE)
+        self._font_size = int(size[1]*FONT_SIZE)
         self._font = pygame.font.Font(
-            pygame.font.get_default_font(), int(size[1]*FONT_SIZE))
+            pygame.font.get_default_font(), self._font_size)
+        self._overlay_font_size = int(size[1]*OVERLAY_FONT_SIZE)
+        self._overlay_font = pygame.font.Font(
+            pygame.font.get_default_font(), self._overlay_font_size)
+        self._cell_rects = [[self._scale_cell_rect(row, col) for col in range(COLUMNS)]
+                            for row in range(ROWS)]
+        self._cell_sprites = {}
+        self._text_surfaces = {}
+        self._full_redraw = True
 
     def _update(self) -> None:
         '''
-        Updates the game by waiting time, handling events, and
-        redrawing the screen.
+        Updates the game by waiting time, handling events, advancing the
+        simulation by the time that passed, and redrawing the screen. In
+        low latency mode the wait ends as soon as an event arrives, so
+        inputs are applied and shown right away instead of at the next
+        frame, and gravity keeps its own time. When threaded, the simulation
+        thread does the advancing and this only waits, handles events and
+        draws.
         '''
-        self._clock.tick(30)
-        self._handle_events()
+        if self._threaded:
+            if not self._simulation.is_alive():
+                raise RuntimeError("the simulation thread stopped")
+            self._clock.tick(FRAME_RATE)
+            start = time.perf_counter()
+            self._handle_events()
+            handled = time.perf_counter()
+        else:
+            if self._low_latency:
+                events = self._wait_for_events()
+                start = time.perf_counter()
+                self._handle_events(events)
+                handled = time.perf_counter()
+                elapsed = handled - self._last_advance
+                self._last_advance = handled
+            else:
+                elapsed = self._clock.tick(FRAME_RATE)/1000
+                start = time.perf_counter()
+                self._handle_events()
+                handled = time.perf_counter()
+            self._advance_frames(elapsed)
+            self._publish_snapshot()
+            advanced = time.perf_counter()
         self._redraw()
-
-    def _clean_up(self) -> None:
+        if self._low_latency and not self._threaded:
+            self._clock.tick()
+        self._timer.record("events", handled - start)
+        if not self._threaded:
+            self._timer.record("update", advanced - handled)
+        self._timer.record("frame", time.perf_counter() - start)
+
+        self._frames_drawn += 1
+        if self._frames_drawn % OVERLAY_REFRESH == 0:
+            self._overlay_lines = self._get_overlay_lines() if self._show_overlay else []
+
+    def _wait_for_events(self) -> [pygame.event.Event]:
         '''
-        Cleans everything up.
+        Waits until an event arrives or the next frame is due and returns
+        the events that are waiting.
         '''
-        pygame.quit()
-
-    def _create_faller(self) -> None:
+        due = 1/FRAME_RATE - self._lag - \
+            (time.perf_counter() - self._last_advance)
+        event = pygame.event.wait(max(1, int(due*1000)))
+        events = pygame.event.get()
+        if event.type != pygame.NOEVENT:
+            events.insert(0, event)
+        return events
+
+    def _advance_frames(self, elapsed: float) -> None:
         '''
-        Creates a faller if there is a column empty, or ends the game.
+        Advances the session by a fixed step for every 1/FRAME_RATE seconds
+        that passed, so slow frames are caught up on instead of slowing the
+        game down. Lag beyond MAX_CATCH_UP_FRAMES is dropped.
         '''
-        empty_cols = self._state.get_empty_cols()
-        if len(empty_cols) == 0:
+        self._lag += elapsed
+        frames = 0
+        while self._lag >= 1/FRAME_RATE:
+            self._lag -= 1/FRAME_RATE
+            frames += 1
+            self._advance_frame()
+            if frames >= MAX_CATCH_UP_FRAMES:
+                self._lag = 0.0
+
+    def _advance_frame(self) -> None:
+        '''
+        Advances the session by one frame if the game is started, and ends
+        the game if it is over.
+        '''
+        if self._started:
+            self._session.advance_frame()
+        if self._session.game_over():
             self._lose_game()
-        else:
-            self._state.initialize_faller(
-                random.choice(empty_cols), self._next_colors)
-            self._queue_next_faller()
 
-    def _queue_next_faller(self) -> None:
+    def _simulate(self) -> None:
+        '''
+        Runs the simulation thread until told to stop with None. Keys sent
+        by the main thread are handled as soon as they arrive, the session
+        is advanced by the time that passed, and a snapshot is published
+        after every pass.
         '''
-        Sets up the colors for the next faller.
+        while True:
+            due = 1/FRAME_RATE - self._lag - \
+                (time.perf_counter() - self._last_advance)
+            try:
+                command = self._commands.get(timeout=max(0, due))
+            except queue.Empty:
+                command = ()
+            if command is None:
+                return
+            start = time.perf_counter()
+            if command:
+                self._handle_key(*command)
+                self._commands_handled += 1
+            self._advance_frames(start - self._last_advance)
+            self._last_advance = start
+            self._publish_snapshot()
+            self._timer.record("update", time.perf_counter() - start)
+
+    def _publish_snapshot(self) -> None:
         '''
-        self._next_colors = [random.choice(
-            list(COLORS.keys())) for color in range(columns_model.FALLER_LENGTH)]
+        Publishes a snapshot of the game along with the inputs applied
+        since the last one.
+        '''
+        self._snapshots.publish(Snapshot(self._state.render_grid(), self._session.score(), self._high_score,
+                                         tuple(self._session.next_colors()), self._started,
+                                         self._session.game_over()), self._input_times, self._commands_handled)
+        self._input_times = []
 
-    def _handle_events(self) -> None:
+    def _clean_up(self) -> None:
+        '''
+        Cleans everything up, stopping the simulation thread first.
         '''
-        Handles the different events and updates the state.
+        if self._simulation:
+            self._commands.put(None)
+            self._simulation.join()
+        self._finish_recording()
+        if self._perf_path:
+            self._timer.dump(self._perf_path)
+        pygame.quit()
+
+    def _handle_events(self, events: [pygame.event.Event] = None) -> None:
         '''
-        for event in pygame.event.get():
+        Handles the different events, taken from the queue if not given,
+        and updates the state.
+        '''
+        for event in pygame.event.get() if events is None else events:
             if event.type == pygame.QUIT:
                 self._close_game()
             elif event.type == pygame.VIDEORESIZE:
                 self._set_surface(event.size)
             elif event.type == pygame.KEYDOWN:
-                if event.key == pygame.K_LEFT and self._started:
-                    self._state.move_faller(columns_model.LEFT)
-                elif event.key == pygame.K_RIGHT and self._started:
-                    self._state.move_faller(columns_model.RIGHT)
-                elif event.key == pygame.K_SPACE:
-                    if not self._started:
-                        self._new_game()
-                    else:
-                        self._state.rotate_faller()
-                elif event.key == pygame.K_DOWN and self._started:
-                    self._update_state()
-                elif event.key == pygame.K_r and self._started:
-                    self._new_game()
-        if self._started:
-            self._frame += 1
-            if self._frame >= max(2, DEFAULT_SPEED/math.log(self._score*ACCELERATION_SPEED + 3)):
-                self._update_state()
-                self._frame = 0
-        if self._state.game_over():
-            self._lose_game()
-
-    def _update_state(self) -> None:
+                if event.key == pygame.K_F3:
+                    self._show_overlay = not self._show_overlay
+                    self._overlay_lines = self._get_overlay_lines() if self._show_overlay else []
+                elif self._threaded:
+                    self._commands.put((event.key, time.perf_counter()))
+                    self._commands_sent += 1
+                else:
+                    self._handle_key(event.key, time.perf_counter())
+
+    def _handle_key(self, key: int, received: float) -> None:
         '''
-        Updates the state and score, creates a faller if there is none.
+        Handles a game key pressed at the given time. When threaded this
+        runs on the simulation thread.
         '''
-        self._state.update()
-        self._score += len(self._state.matching())
-        if self._state.no_faller() and len(self._state.matching()) == 0:
-            self._create_faller()
+        if key == pygame.K_LEFT and self._started:
+            self._apply_input(columns_session.MOVE_LEFT, received)
+        elif key == pygame.K_RIGHT and self._started:
+            self._apply_input(columns_session.MOVE_RIGHT, received)
+        elif key == pygame.K_SPACE:
+            if not self._started:
+                self._new_game()
+            else:
+                self._apply_input(columns_session.ROTATE, received)
+        elif key == pygame.K_DOWN and self._started:
+            self._apply_input(columns_session.DROP, received)
+        elif key == pygame.K_r and self._started:
+            self._new_game()
+
+    def _apply_input(self, action: int, received: float) -> None:
+        '''
+        Gives an input to the session, recording it if the game is being
+        recorded. The time it was received is kept to measure how long it
+        takes to show.
+        '''
+        self._input_times.append(received)
+        if self._recorder:
+            self._recorder.record(self._session.frames(), action)
+        self._session.handle_input(action)
 
     def _new_game(self) -> None:
         '''
-        Starts a new game by resetting the parameters.
+        Starts a new game by resetting the session. When recording, the
+        game gets a fresh seed and its own replay file.
         '''
-        self._initialize_state()
-        self._queue_next_faller()
-        self._frame = 0
-        self._score = 0
+        self._finish_recording()
+        if self._record_dir:
+            seed = random.SystemRandom().getrandbits(63)
+            self._session.new_game(seed)
+            path = os.path.join(
+                self._record_dir, f"{time.strftime('%Y%m%d-%H%M%S')}-{seed:016x}.replay")
+            self._recorder = columns_replay.ReplayWriter(
+                path, ROWS, COLUMNS, list(COLORS.keys()), seed)
+        else:
+            self._session.new_game()
+        self._state = self._session.state()
         self._started = True
 
+    def _finish_recording(self) -> None:
+        '''
+        Ends the replay of the current game, if it is being recorded.
+        '''
+        if self._recorder:
+            self._recorder.finish(
+                self._session.frames(), self._session.score())
+            self._recorder = None
+
     def _redraw(self) -> None:
         '''
-        Redraws the surface, including the field and menu.
+        Redraws the surface, including the field and menu. With dirty
+        rectangles on, only the parts that changed since the last frame are
+        redrawn and updated on the display. When threaded, keys sent this
+        frame are given up to SNAPSHOT_WAIT seconds to show up in the
+        snapshot that is drawn.
+        '''
+        surface = pygame.display.get_surface()
+        start = time.perf_counter()
+        self._snapshot, input_times = self._snapshots.take(
+            self._commands_sent, SNAPSHOT_WAIT)
+        if not self._dirty_rects:
+            surface.fill(BACKGROUND_COLOR)
+            self._draw_field()
+            drawn_field = time.perf_counter()
+            self._draw_menu()
+            rects = None
+        else:
+            full_redraw = self._full_redraw
+            if full_redraw:
+                surface.fill(BACKGROUND_COLOR)
+                self._draw_static_menu()
+                self._drawn_grid = None
+                self._drawn_menu = {}
+                self._full_redraw = False
+            rects = self._redraw_changed_cells()
+            drawn_field = time.perf_counter()
+            rects += self._redraw_changed_menu()
+            if full_redraw:
+                rects = None
+        drawn_menu = time.perf_counter()
+        if rects is None:
+            pygame.display.update()
+        elif rects:
+            pygame.display.update(rects)
+        presented = time.perf_counter()
+        self._timer.record("redraw.field", drawn_field - start)
+        self._timer.record("redraw.menu", drawn_menu - drawn_field)
+        self._timer.record("redraw.flip", presented - drawn_menu)
+        self._record_input_latency(presented, input_times)
+
+    def _record_input_latency(self, presented: float, input_times: [float]) -> None:
+        '''
+        Records the time from each input being handled to the display
+        update that shows it. Inputs are handled as soon as they arrive in
+        low latency mode, but in the frame paced mode they can wait in the
+        queue for up to a frame before that.
+        '''
+        for input_time in input_times:
+            self._timer.record("input.latency", presented - input_time)
+
+    def _redraw_changed_cells(self) -> [pygame.Rect]:
+        '''
+        Redraws the cells that are different from the last frame and
+        returns the rectangles that were drawn.
+        '''
+        grid = self._snapshot.grid()
+        if grid is self._drawn_grid:
+            return []
+        rects = self._draw_changed_cells(
+            pygame.display.get_surface(), grid, self._drawn_grid)
+        self._drawn_grid = grid
+        return rects
+
+    def _draw_changed_cells(self, surface: pygame.Surface, grid: ([[int]], [[str]]), drawn_grid: ([[int]], [[str]])) -> [pygame.Rect]:
+        '''
+        Draws the cells of a render grid that are different from the drawn
+        grid, or every cell if there is no drawn grid, onto a surface at the
+        cell rectangles. Returns the rectangles that were drawn.
+        '''
+        types, colors = grid
+        rects = []
+        for row in range(columns_model.BUFFER_SIZE, len(types)):
+            if drawn_grid and drawn_grid[0][row] == types[row] and drawn_grid[1][row] == colors[row]:
+                continue
+            for col in range(len(types[row])):
+                if not drawn_grid or drawn_grid[0][row][col] != types[row][col] or drawn_grid[1][row][col] != colors[row][col]:
+                    rect = self._get_cell_rect(
+                        row-columns_model.BUFFER_SIZE, col)
+                    surface.blit(self._get_cell_sprite(
+                        types[row][col], colors[row][col]), rect)
+                    rects.append(rect)
+        return rects
+
+    def _redraw_changed_menu(self) -> [pygame.Rect]:
+        '''
+        Redraws the menu regions that are different from the last frame
+        and returns the rectangles that were drawn.
         '''
+        rects = []
         surface = pygame.display.get_surface()
-        surface.fill(BACKGROUND_COLOR)
-        self._draw_field()
-        self._draw_menu()
-        pygame.display.update()
+        for region, (values, rect, draw) in enumerate(self._menu_regions()):
+            if self._drawn_menu.get(region) != values:
+                self._drawn_menu[region] = values
+                surface.fill(BACKGROUND_COLOR, rect)
+                draw()
+                rects.append(rect)
+        return rects
 
     def _draw_field(self) -> None:
         '''
         Draws every cell in the field.
         '''
-        for row in range(columns_model.BUFFER_SIZE, self._state.rows()):
-            for col in range(self._state.cols()):
-                self._draw_cell(row, col)
+        types, colors = self._snapshot.grid()
+        for row in range(columns_model.BUFFER_SIZE, len(types)):
+            for col in range(len(types[row])):
+                self._draw_cell(row, col, types[row][col], colors[row][col])
 
-    def _draw_cell(self, row: int, col: int) -> None:
+    def _draw_cell(self, row: int, col: int, cell_type: int, color: str) -> None:
         '''
-        Draws a cell based on its type.
+        Draws a cell by blitting the sprite for its type and color.
         '''
-        cell_type = self._state.get_type(row, col)
-        rect = self._get_cell_rect(row-columns_model.BUFFER_SIZE, col)
-        if cell_type == columns_model.NONE:
-            self._draw_bordered_rect(rect, EMPTY_COLOR)
-        elif cell_type == columns_model.JEWEL:
-            self._draw_bordered_rect(rect, self._get_color(row, col))
-        elif cell_type == columns_model.FALLER:
-            self._draw_rect(rect, EMPTY_COLOR)
-            self._draw_ellipse(rect, self._get_color(row, col))
-        elif cell_type == columns_model.LANDED:
-            self._draw_rect(rect, self._get_color(row, col))
-        elif cell_type == columns_model.MATCHING:
-            self._draw_rect(rect, MATCHING_COLOR)
-
-    def _get_color(self, row: int, col: int) -> None:
-        return COLORS[self._state.get(row, col)]
+        surface = pygame.display.get_surface()
+        surface.blit(self._get_cell_sprite(cell_type, color), self._get_cell_rect(
+            row-columns_model.BUFFER_SIZE, col))
 
-    def _get_cell_rect(self, row: int, col: int) -> None:
+    def _get_cell_sprite(self, cell_type: int, color: str) -> pygame.Surface:
+        '''
+        Returns the cached sprite of a cell type and color at the current
+        cell size, drawing it the first time it is needed.
+        '''
+        if cell_type in (columns_model.NONE, columns_model.MATCHING):
+            color = None
+        size = self._cell_rects[0][0].size
+        key = (cell_type, color, size)
+        if key not in self._cell_sprites:
+            sprite = pygame.Surface(size).convert()
+            rect = sprite.get_rect()
+            if cell_type == columns_model.NONE:
+                self._draw_bordered_rect(sprite, rect, EMPTY_COLOR)
+            elif cell_type == columns_model.JEWEL:
+                self._draw_bordered_rect(sprite, rect, COLORS[color])
+            elif cell_type == columns_model.FALLER:
+                self._draw_rect(sprite, rect, EMPTY_COLOR)
+                self._draw_ellipse(sprite, rect, COLORS[color])
+            elif cell_type == columns_model.LANDED:
+                self._draw_rect(sprite, rect, COLORS[color])
+            elif cell_type == columns_model.MATCHING:
+                self._draw_rect(sprite, rect, MATCHING_COLOR)
+            self._cell_sprites[key] = sprite
+        return self._cell_sprites[key]
+
+    def _get_cell_rect(self, row: int, col: int) -> pygame.Rect:
+        return self._cell_rects[row][col]
+
+    def _scale_cell_rect(self, row: int, col: int) -> pygame.Rect:
         topleft_x, topleft_y = (MARGIN_SIZE, MARGIN_SIZE)
         cell_width, cell_height = self._get_cell_size()
         return self._scale_rectangle(topleft_x+cell_width*col, topleft_y+cell_height*row, cell_width, cell_height)
@@ -212,43 +616,65 @@ class ColumnsGame:
         field_width, field_height = 0.5-MARGIN_SIZE*2, 1-MARGIN_SIZE*2
         return (field_width/COLUMNS, field_height/ROWS)
 
-    def _scale_rectangle(self, x: float, y: float, width: float, height: float) -> pygame.Rect:
-        surface = pygame.display.get_surface()
-        surface_width, surface_height = surface.get_size()
+    def _scale_rectangle(self, x: float, y: float, width: float, height: float, size: (int, int) = None) -> pygame.Rect:
+        surface_width, surface_height = size or pygame.display.get_surface().get_size()
         return pygame.Rect(int(x*surface_width), int(y*surface_height), int(width*surface_width), int(height*surface_height))
 
     def _scale_position(self, x: float, y: float) -> (int, int):
         surface = pygame.display.get_surface()
         return (int(x*surface.get_width()), int(y*surface.get_height()))
 
-    def _draw_bordered_rect(self, rect: pygame.Rect, color: pygame.Color) -> None:
-        self._draw_rect(rect, color)
-        surface = pygame.display.get_surface()
-        pygame.draw.rect(surface, BORDER_COLOR, rect,
-                         int(BORDER_SIZE*surface.get_width()))
+    def _draw_bordered_rect(self, surface: pygame.Surface, rect: pygame.Rect, color: pygame.Color) -> None:
+        self._draw_rect(surface, rect, color)
+        pygame.draw.rect(surface, BORDER_COLOR, rect, self._border_width())
 
-    def _draw_rect(self, rect: pygame.Rect, color: pygame.Color) -> None:
-        surface = pygame.display.get_surface()
+    def _border_width(self) -> int:
+        return int(BORDER_SIZE*pygame.display.get_surface().get_width())
+
+    def _draw_rect(self, surface: pygame.Surface, rect: pygame.Rect, color: pygame.Color) -> None:
         pygame.draw.rect(surface, color, rect)
 
-    def _draw_ellipse(self, rect: pygame.Rect, color: pygame.Color) -> None:
-        surface = pygame.display.get_surface()
+    def _draw_ellipse(self, surface: pygame.Surface, rect: pygame.Rect, color: pygame.Color) -> None:
         pygame.draw.ellipse(surface, color, rect)
 
     def _draw_menu(self) -> None:
+        self._draw_static_menu()
+        self._draw_scores()
+        self._draw_next_faller()
+        self._draw_status()
+        self._draw_overlay()
+
+    def _menu_regions(self) -> [(tuple, pygame.Rect, callable)]:
+        '''
+        Returns the values shown by each part of the menu that changes
+        during a game, along with the area it covers and how to draw it.
+        The areas never overlap, since clearing one must not erase another.
+        '''
+        cell_width, cell_height = self._get_cell_size()
+        menu_width = 0.5-MARGIN_SIZE
+        snapshot = self._snapshot
+        overlay = self._scale_rectangle(
+            0.5+MARGIN_SIZE, OVERLAY_TOP, menu_width, 1-OVERLAY_TOP)
+        status = self._scale_rectangle(
+            0.5+MARGIN_SIZE, MARGIN_SIZE*15, menu_width, MARGIN_SIZE*2)
+        status.height = min(status.height, overlay.top - status.top)
+        return [((snapshot.score(), snapshot.high_score()),
+                 self._scale_rectangle(
+                     0.5+MARGIN_SIZE, MARGIN_SIZE*2, menu_width, MARGIN_SIZE*2),
+                 self._draw_scores),
+                (snapshot.next_colors(),
+                 self._scale_rectangle(0.5+MARGIN_SIZE, MARGIN_SIZE*5, cell_width,
+                                       cell_width*2+cell_height).inflate(4, 4),
+                 self._draw_next_faller),
+                ((snapshot.started(), snapshot.game_over()), status,
+                 self._draw_status),
+                (tuple(self._overlay_lines), overlay, self._draw_overlay)]
+
+    def _draw_static_menu(self) -> None:
         self._draw_text("COLUMNS!", self._scale_position(
             0.5+MARGIN_SIZE, MARGIN_SIZE))
-        self._draw_text(f"SCORE: {self._score}", self._scale_position(
-            0.5+MARGIN_SIZE, MARGIN_SIZE * 2))
-        self._draw_text(f"HIGH SCORE: {self._high_score}", self._scale_position(
-            0.5+MARGIN_SIZE, MARGIN_SIZE * 3))
-
         self._draw_text(
             "NEXT FALLER:", self._scale_position(0.5+MARGIN_SIZE, MARGIN_SIZE*4))
-        cell_width, cell_height = self._get_cell_size()
-        for i in range(len(self._next_colors)):
-            self._draw_ellipse(self._scale_rectangle(
-                0.5+MARGIN_SIZE, MARGIN_SIZE*5+cell_width*i, cell_width, cell_height), COLORS[self._next_colors[i]])
 
         self._draw_text(f"< and > to move", self._scale_position(
             0.5+MARGIN_SIZE, MARGIN_SIZE * 10))
@@ -259,27 +685,338 @@ class ColumnsGame:
         self._draw_text(f"R to restart", self._scale_position(
             0.5+MARGIN_SIZE, MARGIN_SIZE * 13))
 
-        if not self._started and not self._state.game_over():
+    def _draw_scores(self) -> None:
+        self._draw_text(f"SCORE: {self._snapshot.score()}", self._scale_position(
+            0.5+MARGIN_SIZE, MARGIN_SIZE * 2))
+        self._draw_text(f"HIGH SCORE: {self._snapshot.high_score()}", self._scale_position(
+            0.5+MARGIN_SIZE, MARGIN_SIZE * 3))
+
+    def _draw_next_faller(self) -> None:
+        cell_width, cell_height = self._get_cell_size()
+        next_colors = self._snapshot.next_colors()
+        for i in range(len(next_colors)):
+            self._draw_ellipse(pygame.display.get_surface(), self._scale_rectangle(
+                0.5+MARGIN_SIZE, MARGIN_SIZE*5+cell_width*i, cell_width, cell_height), COLORS[next_colors[i]])
+
+    def _draw_status(self) -> None:
+        if not self._snapshot.started() and not self._snapshot.game_over():
             self._draw_text("Press spacebar to start",
                             self._scale_position(0.5+MARGIN_SIZE, MARGIN_SIZE * 15))
-        elif self._state.game_over():
+        elif self._snapshot.game_over():
             self._draw_text(
                 "GAME OVER", self._scale_position(0.5+MARGIN_SIZE, MARGIN_SIZE * 15))
             self._draw_text("Press spacebar to start again",
                             self._scale_position(0.5+MARGIN_SIZE, MARGIN_SIZE * 16))
 
-    def _draw_text(self, text: str, position: (int, int)) -> None:
+    def _draw_overlay(self) -> None:
+        for i in range(len(self._overlay_lines)):
+            self._draw_text(self._overlay_lines[i], self._scale_position(
+                0.5+MARGIN_SIZE, OVERLAY_TOP+OVERLAY_LINE_SIZE*i), True)
+
+    def _get_overlay_lines(self) -> [str]:
+        '''
+        Returns the lines of the performance overlay: the frame rate and
+        the p50 and p99 durations of every phase.
+        '''
+        lines = [f"FPS: {self._clock.get_fps():.1f}"]
+        for phase in self._timer.phases():
+            lines.append(f"{phase}: {self._timer.percentile(phase, 0.5)*1000:.2f} / "
+                         f"{self._timer.percentile(phase, 0.99)*1000:.2f} ms")
+        return lines
+
+    def _draw_text(self, text: str, position: (int, int), small: bool = False) -> None:
         surface = pygame.display.get_surface()
-        text = self._font.render(text, True, FONT_COLOR)
-        surface.blit(text, text.get_rect().move(position[0], position[1]))
+        surface.blit(self._get_text_surface(text, small), position)
+
+    def _get_text_surface(self, text: str, small: bool = False) -> pygame.Surface:
+        '''
+        Returns the cached rendering of a text at the current font size, or
+        the overlay font size if small. The cache is emptied when it gets
+        too big, since scores keep making new texts.
+        '''
+        font, font_size = (self._overlay_font, self._overlay_font_size) if small else (
+            self._font, self._font_size)
+        key = (text, font_size)
+        if key not in self._text_surfaces:
+            if len(self._text_surfaces) >= TEXT_CACHE_SIZE:
+                self._text_surfaces = {}
+            self._text_surfaces[key] = font.render(text, True, FONT_COLOR)
+        return self._text_surfaces[key]
 
     def _lose_game(self) -> None:
+        self._finish_recording()
         self._started = False
-        self._high_score = max(self._high_score, self._score)
+        self._high_score = max(self._high_score, self._session.score())
 
     def _close_game(self) -> None:
         self._running = False
 
 
+class SpectatorWall(ColumnsGame):
+    '''
+    Shows many games played by the planner at once in a grid of boards,
+    each restarting with a new seed a little while after it ends. Every
+    board is drawn onto its own cached surface. The boards' game states
+    publish the cells they change, so only those cells and the scores that
+    changed are redrawn and updated on the display.
+    '''
+
+    def __init__(self, games: int = WALL_GAMES, seed: int = None, perf_path: str = None):
+        super().__init__(perf_path=perf_path)
+        self._games = games
+        self._seed = seed if seed is not None else random.SystemRandom().getrandbits(63)
+        self._games_started = 0
+        self._board_rects = []
+        self._label_rects = []
+        self._board_surfaces = []
+        self._changed_cells = []
+        self._faller_cells = []
+        self._drawn_scores = []
+
+    def _initialize_state(self) -> None:
+        '''
+        Creates a session and a planner for every board.
+        '''
+        self._sessions = []
+        for game in range(self._games):
+            self._sessions.append(columns_session.GameSession(
+                ROWS, COLUMNS, list(COLORS.keys()), self._next_seed(), timer=self._timer))
+        self._policies = [columns_ai.PlannerPolicy()
+                          for game in range(self._games)]
+        self._restart_frames = [0]*self._games
+        self._changed_cells = [None]*self._games
+        self._faller_cells = [[] for game in range(self._games)]
+        for game in range(self._games):
+            self._watch(game)
+        self._session = self._sessions[0]
+        self._state = self._session.state()
+        self._started = True
+
+    def _set_surface(self, size: (int, int)) -> None:
+        '''
+        Resets the screen surface and lays out the boards in the grid that
+        gives them the biggest cells. All boards are the same size, so they
+        share the cell rectangles and sprites.
+        '''
+        super()._set_surface(size)
+        width, height = size
+
+        def cell_size(grid_cols: int) -> float:
+            grid_rows = math.ceil(self._games/grid_cols)
+            return min(width*(1-WALL_MARGIN*2)/(grid_cols*COLUMNS),
+                       height*(1-WALL_MARGIN*2)/(grid_rows*(ROWS+WALL_LABEL_ROWS)))
+
+        grid_cols = max(range(1, self._games+1), key=cell_size)
+        grid_rows = math.ceil(self._games/grid_cols)
+        tile_width = (1-WALL_MARGIN*2)/grid_cols
+        tile_height = (1-WALL_MARGIN*2)/grid_rows
+        board_height = tile_height*ROWS/(ROWS+WALL_LABEL_ROWS)
+        self._board_rects = []
+        self._label_rects = []
+        for game in range(self._games):
+            x = WALL_MARGIN+tile_width*(game % grid_cols)+tile_width*WALL_GAP
+            y = WALL_MARGIN+tile_height*(game // grid_cols)
+            self._board_rects.append(self._scale_rectangle(
+                x, y, tile_width*(1-WALL_GAP*2), board_height))
+            self._label_rects.append(self._scale_rectangle(
+                x, y+board_height, tile_width*(1-WALL_GAP*2), tile_height-board_height))
+
+        board_size = self._board_rects[0].size
+        self._cell_rects = [[self._scale_rectangle(col/COLUMNS, row/ROWS, 1/COLUMNS, 1/ROWS, board_size)
+                             for col in range(COLUMNS)] for row in range(ROWS)]
+        self._board_surfaces = [pygame.Surface(board_size).convert()
+                                for game in range(self._games)]
+        self._changed_cells = [None]*self._games
+        self._drawn_scores = [None]*self._games
+
+    def _publish_snapshot(self) -> None:
+        '''
+        Does nothing, the wall draws straight from its sessions.
+        '''
+
+    def _border_width(self) -> int:
+        '''
+        Returns the width of cell borders, scaled to the board the way the
+        single game's borders are scaled to its field.
+        '''
+        field_width = 0.5-MARGIN_SIZE*2
+        return max(1, int(BORDER_SIZE*self._board_rects[0].width/field_width))
+
+    def _handle_events(self, events: [pygame.event.Event] = None) -> None:
+        '''
+        Handles closing and resizing the window.
+        '''
+        for event in pygame.event.get() if events is None else events:
+            if event.type == pygame.QUIT:
+                self._close_game()
+            elif event.type == pygame.VIDEORESIZE:
+                self._set_surface(event.size)
+
+    def _advance_frame(self) -> None:
+        '''
+        Advances every board by one frame, giving its planner the chance
+        to make an input every WALL_INPUT_FRAMES frames, staggered across
+        the boards so they don't all plan in the same frame. Boards that are
+        over start a new game after WALL_RESTART_FRAMES frames.
+        '''
+        for game, session in enumerate(self._sessions):
+            if session.game_over():
+                self._restart_frames[game] += 1
+                if self._restart_frames[game] >= WALL_RESTART_FRAMES:
+                    self._restart_frames[game] = 0
+                    session.new_game(self._next_seed())
+                    self._watch(game)
+                continue
+            if (session.frames() + game) % WALL_INPUT_FRAMES == 0:
+                action = self._policies[game](session)
+                if action is not None:
+                    session.handle_input(action)
+            session.advance_frame()
+
+    def _watch(self, game: int) -> None:
+        '''
+        Subscribes to the events of a board's current game state and marks
+        the whole board to be redrawn.
+        '''
+        self._changed_cells[game] = None
+        self._faller_cells[game] = []
+        self._sessions[game].state().subscribe(
+            functools.partial(self._note_changes, game))
+
+    def _note_changes(self, game: int, events: [(str, object)]) -> None:
+        '''
+        Adds the cells changed by a game state's events to the cells of its
+        board to redraw. None means the whole board.
+        '''
+        changed = self._changed_cells[game]
+        for kind, data in events:
+            if changed is None or kind == columns_model.RESET:
+                self._changed_cells[game] = None
+                return
+            if kind == columns_model.FROZEN:
+                changed.update((row, col) for row, col, color in data)
+                self._faller_cells[game] = []
+            elif kind in (columns_model.CLEARED, columns_model.MATCHED):
+                changed.update(data)
+            elif kind == columns_model.DROPPED:
+                for col, old_row, new_row in data:
+                    changed.add((old_row, col))
+                    changed.add((new_row, col))
+            elif kind in (columns_model.FALLER_CREATED, columns_model.FALLER_MOVED,
+                          columns_model.FALLER_ROTATED, columns_model.FALLER_DROPPED):
+                col, rows, colors, landed = data
+                changed.update(self._faller_cells[game])
+                self._faller_cells[game] = [(row, col) for row in rows]
+                changed.update(self._faller_cells[game])
+
+    def _next_seed(self) -> int:
+        '''
+        Returns the seed of the next game to start on any board.
+        '''
+        self._games_started += 1
+        return columns_runner.derive_seed(self._seed, self._games_started - 1)
+
+    def _redraw(self) -> None:
+        '''
+        Redraws the boards and scores that changed onto their cached
+        surfaces and updates only their rectangles on the display, or
+        redraws everything after the window changes.
+        '''
+        surface = pygame.display.get_surface()
+        start = time.perf_counter()
+        full_redraw = self._full_redraw
+        if full_redraw:
+            surface.fill(BACKGROUND_COLOR)
+            self._drawn_scores = [None]*self._games
+            self._full_redraw = False
+        rects = []
+        for game, session in enumerate(self._sessions):
+            if self._redraw_board(game) or full_redraw:
+                surface.blit(self._board_surfaces[game],
+                             self._board_rects[game])
+                rects.append(self._board_rects[game])
+        drawn_field = time.perf_counter()
+        for game, session in enumerate(self._sessions):
+            score = (session.score(), session.game_over())
+            if score != self._drawn_scores[game]:
+                self._drawn_scores[game] = score
+                surface.fill(BACKGROUND_COLOR, self._label_rects[game])
+                self._draw_text(f"{session.score()}{' GAME OVER' if session.game_over() else ''}",
+                                self._label_rects[game].topleft, True)
+                rects.append(self._label_rects[game])
+        drawn_menu = time.perf_counter()
+        if full_redraw:
+            pygame.display.update()
+        elif rects:
+            pygame.display.update(rects)
+        self._timer.record("redraw.field", drawn_field - start)
+        self._timer.record("redraw.menu", drawn_menu - drawn_field)
+        self._timer.record("redraw.flip", time.perf_counter() - drawn_menu)
+
+    def _redraw_board(self, game: int) -> bool:
+        '''
+        Redraws the changed cells of a board onto its surface, or the whole
+        board if it was marked. Returns whether anything was drawn.
+        '''
+        state = self._sessions[game].state()
+        changed = self._changed_cells[game]
+        self._changed_cells[game] = set()
+        if changed is None:
+            return bool(self._draw_changed_cells(self._board_surfaces[game], state.render_grid(), None))
+        buffer_size = state.buffer_size()
+        for row, col in changed:
+            if row >= buffer_size:
+                self._board_surfaces[game].blit(self._get_cell_sprite(
+                    state.get_type(row, col), state.get(row, col)), self._get_cell_rect(row-buffer_size, col))
+        return bool(changed)
+
+
+def run_headless(frames: int, seed: int = None) -> None:
+    '''
+    Plays games with random inputs for a number of frames as fast as
+    possible, without a display, and prints how fast it went.
+    '''
+    session = columns_session.GameSession(
+        ROWS, COLUMNS, list(COLORS.keys()), seed)
+    policy = functools.partial(
+        columns_runner.random_policy, rng=random.Random(seed))
+    advanced, ticks, games = 0, 0, 1
+    start = time.perf_counter()
+    while advanced < frames:
+        advanced += session.fast_forward(frames - advanced, policy)
+        if session.game_over():
+            ticks += session.ticks()
+            session.new_game()
+            games += 1
+    seconds = time.perf_counter() - start
+    ticks += session.ticks()
+    print(f"{frames} frames, {ticks} updates, {games} games in {seconds:.2f}s "
+          f"({frames/seconds:.0f} frames/s, {ticks/seconds:.0f} updates/s)")
+
+
 if __name__ == "__main__":
-    ColumnsGame().run()
+    parser = argparse.ArgumentParser(description="Plays the columns game.")
+    parser.add_argument("--dirty-rects", action="store_true",
+                        help="only redraw the parts of the window that changed")
+    parser.add_argument("--headless", type=int, metavar="FRAMES",
+                        help="play random inputs for FRAMES frames without a display")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--record", metavar="DIR", default=None,
+                        help="record a replay of every game into DIR")
+    parser.add_argument("--perf-dump", metavar="FILE", default=None,
+                        help="write the phase timings to FILE on exit (F3 shows them)")
+    pacing = parser.add_mutually_exclusive_group()
+    pacing.add_argument("--low-latency", action="store_true",
+                        help="apply and show inputs as soon as they arrive instead of once a frame")
+    pacing.add_argument("--threaded", action="store_true",
+                        help="advance the game on its own thread so slow updates don't hold up drawing")
+    parser.add_argument("--spectate", type=int, metavar="GAMES", nargs="?", const=WALL_GAMES,
+                        help="watch GAMES planner games at once (64 by default)")
+    args = parser.parse_args()
+    if args.headless is not None:
+        run_headless(args.headless, args.seed)
+    elif args.spectate:
+        SpectatorWall(args.spectate, args.seed, args.perf_dump).run()
+    else:
+        ColumnsGame(args.dirty_rects, args.record,
+                    args.perf_dump, args.low_latency, args.threaded).run()
@@ -0,0 +1,111 @@
+# test_columns_numpy.py
+# Checks that the NumPy field plays exactly like the list-based Field.
+import random
+import pytest
+import columns_model
+import columns_numpy
+
+SIZES = [(4, 3), (13, 6), (20, 11)]
+RULES = [columns_model.DEFAULT_RULES, columns_model.MatchRules(2),
+         columns_model.MatchRules(4, diagonals=False), columns_model.MatchRules(match_buffer=True)]
+
+
+def random_field(field_class: type, rows: int, cols: int, rules: columns_model.MatchRules, seed: int, density: float = 0.6):
+    '''
+    Returns a field with random colors below the buffer, left floating.
+    '''
+    rng = random.Random(seed)
+    field = field_class(rows, cols, columns_model.BUFFER_SIZE, rules)
+    for row in range(columns_model.BUFFER_SIZE, field.rows()):
+        for col in range(cols):
+            if rng.random() < density:
+                field.set_color(row, col, rng.choice(
+                    columns_model.COLORS[:3]))
+    return field
+
+
+def field_contents(field) -> ([[str]], [(int, int)]):
+    '''
+    Returns the colors of every row and the sorted matching jewels.
+    '''
+    return [field.get_row(row) for row in range(field.rows())], sorted(field.matching())
+
+
+def state_contents(state: columns_model.GameState) -> tuple:
+    '''
+    Returns what can be seen of a game state.
+    '''
+    faller = state.faller()
+    return (state.render_grid(), sorted(state.matching()), state.game_over(),
+            (faller.col(), faller.rows(), faller.colors()) if faller else None)
+
+
+@pytest.mark.parametrize("rows,cols", SIZES)
+@pytest.mark.parametrize("rules", RULES)
+def test_settling_matches_list_field(rows: int, cols: int, rules: columns_model.MatchRules) -> None:
+    for seed in range(20):
+        fields = [random_field(field_class, rows, cols, rules, seed)
+                  for field_class in (columns_model.Field, columns_numpy.NumpyField)]
+        for step in range(rows):
+            for field in fields:
+                field.clear_matching()
+                field.drop_field()
+                field.locate_matching()
+            assert field_contents(fields[0]) == field_contents(fields[1])
+            assert fields[0].no_matching() == fields[1].no_matching()
+            assert fields[0].empty_buffer() == fields[1].empty_buffer()
+            for col in range(cols):
+                assert fields[0].column_full(col) == fields[1].column_full(col)
+                assert fields[0].landing_row(0, col) == fields[1].landing_row(0, col)
+
+
+@pytest.mark.parametrize("rows,cols", SIZES)
+@pytest.mark.parametrize("rules", RULES)
+def test_games_match_list_field(rows: int, cols: int, rules: columns_model.MatchRules) -> None:
+    for seed in range(10):
+        rng = random.Random(seed)
+        states = [columns_model.GameState(field_class, rules)
+                  for field_class in (columns_model.Field, columns_numpy.NumpyField)]
+        contents = [[rng.choice(columns_model.COLORS[:3]) if rng.random() < 0.4 else columns_model.BLANK
+                     for col in range(cols)] for row in range(rows)]
+        for state in states:
+            state.initialize_field(rows, cols)
+            state.initialize_contents(contents)
+        for step in range(300):
+            if states[0].game_over():
+                break
+            choice = rng.random()
+            col = rng.randrange(cols)
+            colors = [rng.choice(columns_model.COLORS[:3])
+                      for jewel in range(columns_model.FALLER_LENGTH)]
+            direction = rng.choice((columns_model.LEFT, columns_model.RIGHT))
+            for state in states:
+                if state.no_faller() and not state.matching() and choice < 0.5:
+                    state.initialize_faller(col, colors)
+                elif choice < 0.2:
+                    state.move_faller(direction)
+                elif choice < 0.3:
+                    state.rotate_faller()
+                elif choice < 0.35:
+                    state.hard_drop()
+                else:
+                    state.update()
+            assert state_contents(states[0]) == state_contents(states[1])
+
+
+def test_clone_and_bytes_match_list_field() -> None:
+    contents = [[columns_model.COLORS[(row + col) % 4] if row > 8 else columns_model.BLANK
+                 for col in range(6)] for row in range(13)]
+    states = [columns_model.GameState(field_class)
+              for field_class in (columns_model.Field, columns_numpy.NumpyField)]
+    for state in states:
+        state.initialize_field(13, 6)
+        state.initialize_contents(contents)
+        state.initialize_faller(2, ["S", "T", "V"])
+        state.update()
+    expected = state_contents(states[0])
+    assert state_contents(states[1]) == expected
+    assert state_contents(states[1].clone()) == expected
+    restored = columns_model.GameState.from_bytes(
+        states[1].to_bytes(), columns_numpy.NumpyField)
+    assert state_contents(restored) == expected